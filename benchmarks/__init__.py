@@ -0,0 +1,4 @@
+#!/usr/bin/env python3
+
+## Benchmarks of func_calc and func_stats on synthetic data with the shapes of the EUR-11 simulations
+## Run from the repository root: python -m benchmarks.run --sizes small medium --output benchmark.json
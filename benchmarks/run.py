@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+## Time func_calc and func_stats on synthetic data and record wall time and peak memory to JSON
+## python -m benchmarks.run --sizes small medium --output benchmark.json [--compare previous.json]
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import datetime
+import subprocess
+import tracemalloc
+import numpy as np
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # func_* modules in the repository root
+import func_calc
+import func_stats
+from benchmarks import synthetic
+
+paired = ['nfn-ssp1', 'nfs-ssp1', 'nac-ssp1'] # as in the summary tables
+independent = [('ssp1', 'recent')]
+
+# Benchmarks: name -> (setup, run)
+# setup(size) builds the inputs (not timed), run(*inputs) is timed
+benchmarks = {
+    'seasonal_clim': (
+        lambda size: (synthetic.monthly_series(size),),
+        lambda ds: func_calc.seasonal_clim(ds)),
+    'agg_clim:seas-series': (
+        lambda size: (synthetic.monthly_series(size),),
+        lambda ds: func_calc.agg_clim(ds, 'seas-series')),
+    'agg_clim:ann-series': (
+        lambda size: (synthetic.monthly_series(size),),
+        lambda ds: func_calc.agg_clim(ds, 'ann-series')),
+    'agg_clim:seas-variability': (
+        lambda size: (synthetic.monthly_series(size),),
+        lambda ds: func_calc.agg_clim(ds, 'seas-variability')),
+    'agg_clim_multi': (
+        lambda size: (synthetic.monthly_series(size),),
+        lambda ds: func_calc.agg_clim_multi(ds, ['seas-climatology', 'seas-series', 'ann-series'])),
+    'veg_seasonal_mean': (
+        lambda size: (synthetic.surface(size),),
+        lambda surf: func_calc.veg_seasonal_mean(surf, 'TLAI')),
+    'xr_significance': (
+        lambda size: (synthetic.seasonal_series(size, variables=synthetic.variables[:2]),),
+        lambda ds: func_stats.xr_significance(ds, test_dim='time', split_dim='season', paired_samples=paired,
+                                              independent_samples=independent, multitest=True)),
+    'multitest_bh': (
+        lambda size: (synthetic.pvalues(size),),
+        lambda p: func_stats.multitest_bh(p)),
+    'ds_ds_corr': (
+        lambda size: (synthetic.land_cover(size), synthetic.seasonal_climatology(size), synthetic.cell_area(size).fillna(0)),
+        lambda ds1, ds2, area: func_calc.ds_ds_corr(ds1, ds2, dim=['lat', 'lon'], weights=area)),
+    'summarize_stat_dim': (
+        lambda size: (synthetic.significance_stats(n_regions=synthetic._shape(size)[0]),),
+        lambda ds: func_stats.summarize_stat_dim(ds, stat_dim='stat', blank_cases=['recent', 'ssp1'], nan_label='')),
+}
+
+def _nbytes(inputs):
+    return sum(obj.nbytes for obj in inputs if hasattr(obj, 'nbytes'))
+
+# Wall time of `repeat` runs, then peak memory (traced numpy and Python allocations) of one more run
+def measure(run, inputs, repeat=3):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        run(*inputs)
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    try:
+        run(*inputs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'time_s': times, 'best_s': min(times), 'median_s': float(np.median(times)), 'peak_mb': peak/2**20}
+
+# Run the selected benchmarks at each size; failures are recorded instead of aborting the run
+def run_benchmarks(names=None, sizes=['small', 'medium'], repeat=3, verbose=True):
+    results = []
+    for size in sizes:
+        for name in (names or benchmarks):
+            setup, run = benchmarks[name]
+            entry = {'name': name, 'size': size, 'grid': list(synthetic._shape(size))}
+            try:
+                inputs = setup(size)
+                entry['input_mb'] = _nbytes(inputs)/2**20
+                entry.update(measure(run, inputs, repeat=repeat))
+            except Exception as e:
+                entry['error'] = f'{type(e).__name__}: {e}'
+            results.append(entry)
+            if verbose:
+                if 'error' in entry:
+                    print(f"{name:24s} {size:8s} error: {entry['error'][:80]}")
+                else:
+                    print(f"{name:24s} {size:8s} {entry['best_s']:10.4f} s {entry['peak_mb']:10.1f} MB")
+    return results
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def metadata():
+    return {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'xarray': xr.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count()}
+
+# Ratios new/old of best time and peak memory for benchmarks present in both files
+def compare(old, new):
+    previous = {(r['name'], r['size']): r for r in old['results'] if 'error' not in r}
+    rows = []
+    for r in new['results']:
+        p = previous.get((r['name'], r['size']))
+        if p is None or 'error' in r:
+            continue
+        rows.append({'name': r['name'], 'size': r['size'],
+                     'time_ratio': r['best_s']/p['best_s'], 'memory_ratio': r['peak_mb']/p['peak_mb'] if p['peak_mb'] else np.nan})
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark func_calc and func_stats on synthetic EUR-11 data')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=list(synthetic.sizes))
+    parser.add_argument('--only', nargs='+', default=None, choices=list(benchmarks), help='subset of benchmarks')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', default=None, help='previous JSON output to compare with')
+    args = parser.parse_args(argv)
+
+    out = {'meta': metadata(), 'results': run_benchmarks(args.only, args.sizes, repeat=args.repeat)}
+    with open(args.output, 'w') as f:
+        json.dump(out, f, indent=1)
+    print('->', args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        for row in compare(old, out):
+            print(f"{row['name']:24s} {row['size']:8s} time x{row['time_ratio']:.2f} memory x{row['memory_ratio']:.2f}")
+
+if __name__ == '__main__':
+    main()
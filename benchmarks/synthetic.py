@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+## Synthetic datasets with the shapes of the EUR-11 simulations (412x424 grid, 15 years, cases, PFTs)
+## Values are random but reproducible (seeded), sea cells are NaN as in the processed files
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Grid sizes (lat, lon); 'full' is the EUR-11 grid
+sizes = {'small': (52, 53),
+         'medium': (103, 106),
+         'large': (206, 212),
+         'full': (412, 424)}
+
+# Cases as in the notebooks (single scenarios and differences to SSP1)
+cases = ['recent', 'ssp1', 'nfn-ssp1', 'nfs-ssp1', 'nac-ssp1']
+
+# Climate variables as in the summary tables
+variables = ['T_2M', 'TSOI_10CM', 'WIND_10M', 'PRECIP', 'SOILWATER_10CM', 'GPP']
+
+# Land cover variables of the surface files
+variables_lc = ['PCT_TREE_NL', 'PCT_TREE_BL', 'PCT_SHRUB', 'PCT_GRASS', 'PCT_CROP', 'PCT_BARE']
+
+n_pft = 17 # lsmpft
+years = 15
+
+def _shape(size):
+    return sizes[size] if isinstance(size, str) else tuple(size)
+
+def _coords(size):
+    nlat, nlon = _shape(size)
+    return {'lat': np.linspace(27., 72., nlat), 'lon': np.linspace(-22., 45., nlon)}
+
+# Land mask: smooth random field thresholded to ca. 55% land, with sea along the borders
+def land_mask(size='small', seed=0):
+    nlat, nlon = _shape(size)
+    rng = np.random.default_rng(seed)
+    y, x = np.meshgrid(np.linspace(0, 1, nlat), np.linspace(0, 1, nlon), indexing='ij')
+    field = np.zeros((nlat, nlon))
+    for _ in range(12): # sum of random waves with wavelengths of a few hundred km
+        kx, ky = rng.uniform(1, 6, 2)
+        field += np.sin(2*np.pi*(kx*x + rng.random())) * np.sin(2*np.pi*(ky*y + rng.random()))
+    field -= 4*((x - 0.5)**2 + (y - 0.5)**2) # more sea towards the borders
+    land = field > np.quantile(field, 0.45)
+    return xr.DataArray(land, coords=_coords(size), dims=('lat', 'lon'), name='land')
+
+# Grid cell area (km2), NaN over sea
+def cell_area(size='small', seed=0):
+    coords = _coords(size)
+    area = 121. * np.cos(np.deg2rad(coords['lat']))[:, None] * np.ones(len(coords['lon']))
+    area = xr.DataArray(area, coords=coords, dims=('lat', 'lon'), name='AREA').assign_attrs(units='km^2')
+    return area.where(land_mask(size, seed))
+
+def _noise(rng, shape, dtype):
+    return rng.standard_normal(shape, dtype=np.float32).astype(dtype, copy=False)
+
+# Monthly series of one scenario (time, lat, lon), e.g., input of seasonal_clim and agg_clim
+def monthly_series(size='small', variables=variables, n_years=years, start='2036-01-01', seed=0, dtype=np.float32):
+    rng = np.random.default_rng(seed)
+    coords = _coords(size)
+    time = pd.date_range(start, periods=12*n_years, freq='MS')
+    cycle = np.cos(2*np.pi*(time.month.values - 7)/12)[:, None, None] # seasonal cycle, max in July
+    land = land_mask(size, seed).values
+    shape = (len(time),) + land.shape
+    data_vars = dict()
+    for i, var in enumerate(variables):
+        values = (10*(i + 1) + 5*cycle + _noise(rng, shape, dtype)).astype(dtype)
+        values[:, ~land] = np.nan
+        data_vars[var] = (('time', 'lat', 'lon'), values, {'units': '-'})
+    return xr.Dataset(data_vars, coords={'time': time, **coords})
+
+# Seasonal series of all cases (case, time, lat, lon), e.g., input of xr_significance
+# Time stamps are the first month of each season (QS-DEC), with a 'season' coordinate on time for splitting
+def seasonal_series(size='small', variables=variables, cases=cases, n_years=years, start='2035-12-01', seed=0, dtype=np.float32):
+    rng = np.random.default_rng(seed)
+    coords = _coords(size)
+    time = pd.date_range(start, periods=4*n_years, freq='QS-DEC')
+    land = land_mask(size, seed).values
+    shape = (len(cases), len(time)) + land.shape
+    shift = np.array([0. if '-' not in case else 0.1*k for k, case in enumerate(cases)], dtype=dtype)[:, None, None, None]
+    data_vars = dict()
+    for var in variables:
+        values = (shift + _noise(rng, shape, dtype)).astype(dtype)
+        values[:, :, ~land] = np.nan
+        data_vars[var] = (('case', 'time', 'lat', 'lon'), values)
+    season = pd.Series(time.month).map({12: 'DJF', 3: 'MAM', 6: 'JJA', 9: 'SON'}).values
+    return xr.Dataset(data_vars, coords={'case': cases, 'time': time, 'season': ('time', season), **coords})
+
+# Seasonal climatology of all cases (case, season, lat, lon)
+def seasonal_climatology(size='small', variables=variables, cases=cases, seed=0, dtype=np.float32):
+    rng = np.random.default_rng(seed)
+    land = land_mask(size, seed).values
+    shape = (len(cases), 4) + land.shape
+    data_vars = dict()
+    for var in variables:
+        values = _noise(rng, shape, dtype)
+        values[:, :, ~land] = np.nan
+        data_vars[var] = (('case', 'season', 'lat', 'lon'), values)
+    return xr.Dataset(data_vars, coords={'case': cases, 'season': ['DJF', 'MAM', 'JJA', 'SON'], **_coords(size)})
+
+# Land cover changes of all cases (case, lat, lon), in % of the grid cell
+def land_cover(size='small', variables=variables_lc, cases=cases, seed=0, dtype=np.float32):
+    rng = np.random.default_rng(seed)
+    land = land_mask(size, seed).values
+    shape = (len(cases),) + land.shape
+    data_vars = dict()
+    for var in variables:
+        values = (20*_noise(rng, shape, dtype)).astype(dtype)
+        values[:, ~land] = np.nan
+        data_vars[var] = (('case', 'lat', 'lon'), values)
+    return xr.Dataset(data_vars, coords={'case': cases, **_coords(size)})
+
+# Surface dataset with monthly PFT-level series (time, lsmpft, lat, lon) and PFT fractions summing to 100%
+def surface(size='small', variables=['TLAI'], n_years=years, start='2036-01-01', seed=0, dtype=np.float32):
+    rng = np.random.default_rng(seed)
+    coords = _coords(size)
+    time = pd.date_range(start, periods=12*n_years, freq='MS')
+    land = land_mask(size, seed).values
+    pct_pft = rng.random((n_pft,) + land.shape).astype(dtype)
+    pct_pft *= 100/pct_pft.sum(axis=0)
+    pct_natveg = (100*rng.random(land.shape)).astype(dtype)
+    surf = xr.Dataset({'pct_pft': (('lsmpft', 'lat', 'lon'), pct_pft),
+                       'PCT_NATVEG': (('lat', 'lon'), pct_natveg),
+                       'PCT_CROP': (('lat', 'lon'), 100 - pct_natveg),
+                       'AREA': cell_area(size, seed)},
+                      coords={'time': time, 'lsmpft': np.arange(n_pft), **coords})
+    for var in variables:
+        values = np.abs(_noise(rng, (len(time), n_pft) + land.shape, dtype))
+        values[:, :, ~land] = np.nan
+        surf[var] = (('time', 'lsmpft', 'lat', 'lon'), values)
+    return surf
+
+# P-values of all cases (case, season, lat, lon), ca. 10% below 0.05
+def pvalues(size='small', cases=cases, seed=0):
+    rng = np.random.default_rng(seed)
+    land = land_mask(size, seed).values
+    p = rng.random((len(cases), 4) + land.shape)**2
+    p[:, :, ~land] = np.nan
+    return xr.DataArray(p, coords={'case': cases, 'season': ['DJF', 'MAM', 'JJA', 'SON'], **_coords(size)},
+                        dims=('case', 'season', 'lat', 'lon'), name='p')
+
+# Output of xr_significance as rearranged in the summary tables: one variable per climate variable,
+# dims (stat, case, region, season) with stat = statistic, p, effect_size
+def significance_stats(n_regions=16, variables=variables, cases=cases, seed=0):
+    rng = np.random.default_rng(seed)
+    shape = (len(cases), n_regions, 5)
+    data_vars = dict()
+    for var in variables:
+        stat = np.stack([rng.uniform(0, 1000, shape), rng.random(shape)**3, rng.uniform(-1, 1, shape)])
+        stat[:, rng.random(shape) < 0.05] = np.nan
+        data_vars[var] = (('stat', 'case', 'region', 'season'), stat)
+    return xr.Dataset(data_vars, coords={'stat': ['statistic', 'p', 'effect_size'], 'case': cases,
+                                         'region': [f'R{i}' for i in range(n_regions)],
+                                         'season': ['Annual', 'DJF', 'MAM', 'JJA', 'SON']})
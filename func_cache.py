@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+## On-disk memoization of expensive intermediate results (e.g., seasonal means, regional series, significance tests)
+## Results are keyed on the function, its arguments (hashed with dask's tokenize, which includes the data of in-memory
+## objects and the file name and modification time of lazily opened files) and optionally on input files.
+## Datasets/DataArrays are stored as NetCDF (or Zarr), DataFrames as Parquet, anything else (or if writing fails) as pickle.
+## The cache directory is limited in size; least recently used entries are removed first.
+
+import os
+import json
+import time
+import pickle
+import shutil
+import hashlib
+import inspect
+import functools
+import glob as _glob
+import pandas as pd
+import xarray as xr
+from dask.base import tokenize
+from settings import dpath_cache
+
+max_size = 20 * 2**30 # bytes
+
+# Signature of input files: size and modification time, or the content hash (slower) with checksum=True
+def _file_signature(path, checksum=False):
+    if os.path.isdir(path): # e.g., Zarr stores
+        files = sorted(f for f in _glob.glob(os.path.join(path, '**'), recursive=True) if os.path.isfile(f))
+        return [(os.path.relpath(f, path), _file_signature(f, checksum)) for f in files]
+    if checksum:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**24), b''):
+                h.update(block)
+        return h.hexdigest()
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+def _input_files(files, args, kwargs):
+    if files is None:
+        return []
+    paths = files(*args, **kwargs) if callable(files) else files
+    paths = [paths] if isinstance(paths, str) else list(paths)
+    return sorted(set(p for path in paths for p in (_glob.glob(path) or [path])))
+
+# Source code of the function, so that entries are invalidated when the function itself is edited (not the functions it calls)
+def _func_signature(func):
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        return getattr(getattr(func, '__code__', None), 'co_code', None)
+
+# Cache key: hash of function, arguments and input file signatures
+def cache_key(func, args=(), kwargs={}, files=None, checksum=False):
+    signatures = [(path, _file_signature(path, checksum)) for path in _input_files(files, args, kwargs)]
+    return tokenize(func.__module__, func.__qualname__, _func_signature(func), args, sorted(kwargs.items()), signatures)
+
+# ---- Storage of one result object in an entry directory ----
+
+def _write_item(obj, path, format=None):
+    item = {'kind': type(obj).__name__}
+    try:
+        if isinstance(obj, (xr.Dataset, xr.DataArray)):
+            ds = obj
+            if isinstance(obj, xr.DataArray):
+                item['name'] = obj.name
+                ds = obj.to_dataset(name='__dataarray__')
+            if format == 'zarr':
+                ds.to_zarr(path + '.zarr', mode='w')
+                return dict(item, file=os.path.basename(path) + '.zarr', storage='zarr')
+            ds.to_netcdf(path + '.nc')
+            return dict(item, file=os.path.basename(path) + '.nc', storage='netcdf')
+        if isinstance(obj, (pd.DataFrame, pd.Series)):
+            (obj.to_frame() if isinstance(obj, pd.Series) else obj).to_parquet(path + '.parquet')
+            return dict(item, file=os.path.basename(path) + '.parquet', storage='parquet')
+    except Exception: # e.g., tuple variable names, object dtypes, or no Parquet engine installed
+        for leftover in _glob.glob(path + '.*'):
+            shutil.rmtree(leftover) if os.path.isdir(leftover) else os.remove(leftover)
+    with open(path + '.pkl', 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return dict(item, file=os.path.basename(path) + '.pkl', storage='pickle')
+
+def _read_item(item, entry):
+    path = os.path.join(entry, item['file'])
+    if item['storage'] in ['netcdf', 'zarr']:
+        ds = xr.load_dataset(path) if item['storage'] == 'netcdf' else xr.open_zarr(path).load()
+        if item['kind'] == 'DataArray':
+            da = ds['__dataarray__']
+            da.name = item['name']
+            return da
+        return ds
+    if item['storage'] == 'parquet':
+        df = pd.read_parquet(path)
+        return df.iloc[:, 0] if item['kind'] == 'Series' else df
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+# Tuples and lists (e.g., (masks, means)) and dicts of results are stored item by item
+def _write_entry(result, entry, format=None):
+    if isinstance(result, (tuple, list)):
+        items = [_write_item(obj, os.path.join(entry, f'item{i}'), format) for i, obj in enumerate(result)]
+        return {'container': type(result).__name__, 'items': items}
+    if isinstance(result, dict) and all(isinstance(k, str) for k in result):
+        items = [dict(_write_item(obj, os.path.join(entry, f'item{i}'), format), key=k) for i, (k, obj) in enumerate(result.items())]
+        return {'container': 'dict', 'items': items}
+    return {'container': None, 'items': [_write_item(result, os.path.join(entry, 'item0'), format)]}
+
+def _read_entry(meta, entry):
+    values = [_read_item(item, entry) for item in meta['items']]
+    if meta['container'] == 'tuple':
+        return tuple(values)
+    if meta['container'] == 'list':
+        return values
+    if meta['container'] == 'dict':
+        return {item['key']: value for item, value in zip(meta['items'], values)}
+    return values[0]
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+# ---- Cache directory ----
+
+def _entries(cache_dir):
+    for meta_file in _glob.glob(os.path.join(cache_dir, '*', '*', 'meta.json')):
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+        except (OSError, ValueError): # entry being written or removed
+            continue
+        yield os.path.dirname(meta_file), meta
+
+def _touch(entry):
+    os.utime(os.path.join(entry, 'meta.json')) # last access for the LRU eviction
+
+# Remove least recently used entries until the cache is below max_size (bytes)
+def evict(cache_dir=dpath_cache, max_size=max_size):
+    entries = sorted(_entries(cache_dir), key=lambda e: os.path.getmtime(os.path.join(e[0], 'meta.json')))
+    total = sum(meta['size'] for _, meta in entries)
+    for entry, meta in entries:
+        if total <= max_size:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= meta['size']
+    return total
+
+# Remove all entries (of one function if func is given)
+def clear_cache(func=None, cache_dir=dpath_cache):
+    for entry, meta in list(_entries(cache_dir)):
+        if func is None or meta['function'] == f'{func.__module__}.{func.__qualname__}':
+            shutil.rmtree(entry, ignore_errors=True)
+
+# Summary of the cache content, one row per entry
+def cache_info(cache_dir=dpath_cache):
+    rows = [{'function': meta['function'], 'key': meta['key'], 'size_MB': meta['size']/2**20, 'created': meta['created'],
+             'last_access': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(os.path.join(entry, 'meta.json'))))}
+            for entry, meta in _entries(cache_dir)]
+    return pd.DataFrame(rows, columns=['function', 'key', 'size_MB', 'created', 'last_access'])
+
+# Decorator: memoize(files=lambda scenario, file: [...])(func) or @memoize()
+# - files: input files (paths or glob patterns, or a function of the call arguments returning them) that invalidate the entry when changed
+# - checksum: hash the content of the input files instead of using size and modification time
+# - format: 'netcdf' (default) or 'zarr' for xarray results
+# - cache_dir, max_size: location and size limit (bytes) of the cache; set cache_dir=None to disable caching
+def memoize(files=None, checksum=False, format=None, cache_dir=dpath_cache, max_size=max_size):
+    def decorator(func):
+        name = f'{func.__module__}.{func.__qualname__}'
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if cache_dir is None:
+                return func(*args, **kwargs)
+            key = cache_key(func, args, kwargs, files=files, checksum=checksum)
+            entry = os.path.join(cache_dir, name, key)
+            if os.path.isfile(os.path.join(entry, 'meta.json')):
+                with open(os.path.join(entry, 'meta.json')) as f:
+                    meta = json.load(f)
+                _touch(entry)
+                return _read_entry(meta, entry)
+
+            result = func(*args, **kwargs)
+
+            tmp = entry + f'.tmp{os.getpid()}' # written completely before it becomes visible
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+            meta = _write_entry(result, tmp, format)
+            meta.update({'function': name, 'key': key, 'size': _dir_size(tmp), 'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                         'files': _input_files(files, args, kwargs)})
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump(meta, f, indent=1)
+            if os.path.isdir(entry): # written by another process in the meantime
+                shutil.rmtree(tmp, ignore_errors=True)
+            else:
+                os.replace(tmp, entry)
+            evict(cache_dir, max_size)
+            return result
+
+        wrapper.cache_key = lambda *args, **kwargs: cache_key(func, args, kwargs, files=files, checksum=checksum)
+        wrapper.clear = lambda: clear_cache(func, cache_dir)
+        return wrapper
+    return decorator
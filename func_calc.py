@@ -6,9 +6,11 @@
 import numpy as np
 import pandas as pd
 import scipy
+import scipy.sparse
 import xarray as xr
 import numpy as np
 import xarray as xr
+from func_profile import profile
 
 # Recalculate fractions (albedo, EF) after sub-annual aggregation
 def recalculate_frac(ds):
@@ -19,6 +21,7 @@ def recalculate_frac(ds):
     return ds
 
 # Seasonal climatology (weight by days in month if calculated from monthly series)
+@profile
 def seasonal_clim(ds):
     month_length = ds.time.dt.days_in_month
     month_weights = (month_length.groupby('time.season') / month_length.groupby('time.season').sum()) # weights as fraction of 120 months in 10 years
@@ -30,16 +33,12 @@ def seasonal_clim(ds):
     return ds_seas
 
 # Temporal aggregation
+@profile(labels=['agg'])
 def agg_clim(ds, agg=None):
     if agg == 'seas-climatology':
         ds_agg = seasonal_clim(ds) 
-    elif agg == 'seas-series':
-        ds_agg = ds.resample(time='QS-DEC', keep_attrs=True).mean(dim='time', keep_attrs=True) # quarterly, starting on December 1
-        ds_agg = recalculate_frac(ds_agg)            
-    elif agg == 'seas-variability':
-        ds_agg = ds.resample(time='QS-DEC', keep_attrs=True).mean(dim='time', keep_attrs=True) # quarterly, starting on December 1
-        ds_agg = 100*(ds_seas.groupby('time.month').std(dim='time')/ds_seas.groupby('time.month').mean(dim='time')) # CV in %
-        ds_agg = ds_seas.rename({'month': 'season'}).assign_coords(season=['MAM','JJA','SON','DJF']) # after aggregating across years, create season coordinate
+    elif agg in ['seas-series', 'seas-variability']:
+        ds_agg = agg_clim_multi(ds, [agg])[agg] # quarterly means starting on December 1 (same code path as agg_clim_multi)
     elif agg in ['ann-series', 'ann-climatology']:
         month_length = ds.time.dt.days_in_month
         month_weights = (month_length.groupby('time.year') / month_length.groupby('time.year').sum()) # weights as fraction of 120 months in 10 years
@@ -52,21 +51,125 @@ def agg_clim(ds, agg=None):
             ds_agg = recalculate_frac(ds_agg)
     return ds_agg
 
-# Weighted by PFT fractions
-def veg_seasonal_mean(surf, variable):
+# Several temporal aggregations from one pass over a monthly series, e.g. aggs=['seas-climatology', 'ann-series']
+# Month-length weighted sums are computed once and shared between the seasonal and annual aggregations,
+# and the quarterly means are shared between 'seas-series' and 'seas-variability'
+# For dask-backed input the results share one task graph; compute=True evaluates them together so that each chunk is read once
+@profile
+def agg_clim_multi(ds, aggs, compute=False):
+    unknown = set(aggs) - {'seas-climatology', 'seas-series', 'seas-variability', 'ann-series', 'ann-climatology'}
+    if unknown:
+        raise ValueError(f"Unknown aggregation(s): {sorted(unknown)}")
+
+    results = dict()
+    notnull = ds.isel(time=0, drop=True).notnull()
     with xr.set_options(keep_attrs=True): # to preserve the units
-        cell_mean = (surf[variable]*surf['pct_pft']/100).sum(dim='lsmpft')
-        seas = seasonal_clim(cell_mean)
-        seas = seas.where(surf['AREA'].notnull()) # set to nan instead of 0
+        if {'seas-climatology', 'ann-series', 'ann-climatology'} & set(aggs):
+            month_length = ds.time.dt.days_in_month
+            ds_days = ds * month_length # weighted by days in month, shared by seasonal and annual sums
+
+        if 'seas-climatology' in aggs:
+            ds_agg = ds_days.groupby('time.season').sum(dim='time') / month_length.groupby('time.season').sum()
+            results['seas-climatology'] = ds_agg.where(notnull) # set to nan instead of 0
+
+        if {'seas-series', 'seas-variability'} & set(aggs):
+            ds_seas = ds.resample(time='QS-DEC').mean(dim='time') # quarterly, starting on December 1
+            if 'seas-series' in aggs:
+                results['seas-series'] = ds_seas.copy()
+            if 'seas-variability' in aggs:
+                ds_agg = 100*(ds_seas.groupby('time.month').std(dim='time')/ds_seas.groupby('time.month').mean(dim='time')) # CV in %
+                results['seas-variability'] = ds_agg.rename({'month': 'season'}).assign_coords(season=['MAM','JJA','SON','DJF'])
+
+        if {'ann-series', 'ann-climatology'} & set(aggs):
+            ds_ann = ds_days.groupby('time.year').sum(dim='time') / month_length.groupby('time.year').sum()
+            ds_ann = recalculate_frac(ds_ann.where(notnull)) if isinstance(ds, xr.Dataset) else ds_ann.where(notnull)
+            if 'ann-series' in aggs:
+                results['ann-series'] = ds_ann
+            if 'ann-climatology' in aggs:
+                results['ann-climatology'] = ds_ann.mean(dim='year')
+
+    # Recalculate fractions after aggregation (as in agg_clim)
+    if isinstance(ds, xr.Dataset):
+        for agg in ['seas-climatology', 'seas-series', 'ann-climatology']:
+            if agg in results:
+                results[agg] = recalculate_frac(results[agg])
+
+    if compute:
+        results = _compute_together(results)
+    return {agg: results[agg] for agg in aggs}
+
+# Compute a dict of lazy Datasets/DataArrays in one dask call (shared intermediates are evaluated once)
+@profile
+def _compute_together(objs):
+    import dask
+    arrays = {(key, var): da for key, obj in objs.items()
+              for var, da in (obj.data_vars.items() if isinstance(obj, xr.Dataset) else [(None, obj)])
+              if dask.is_dask_collection(da)}
+    values = dask.compute(*[da.data for da in arrays.values()])
+    out = {key: obj.copy() for key, obj in objs.items()}
+    for (key, var), value in zip(arrays, values):
+        if var is None:
+            out[key] = out[key].copy(data=value)
+        else:
+            out[key][var] = out[key][var].copy(data=value)
+    return out
+
+# Month weights of seasonal_clim as a (time, season) matrix, so that the seasonal sums are one contraction over time
+def season_weights(time):
+    month_length = time.dt.days_in_month
+    month_weights = (month_length.groupby('time.season') / month_length.groupby('time.season').sum()).values
+    season = time.dt.season.values
+    seasons = np.unique(season) # same order as groupby
+    return xr.DataArray(np.where(season[:, None] == seasons, month_weights[:, None], 0.),
+                        coords={'time': time, 'season': seasons}, dims=('time', 'season'))
+
+# Kernel of _pft_seasonal_mean on (..., time, lsmpft) blocks: PFT sum as one einsum, then month weights as one matrix product
+# NaNs count as 0 as in the skipna sums; cells without any value are set directly, others with NaNs are summed individually
+def _pft_seasonal_kernel(x, frac, weights, scale):
+    frac = np.broadcast_to(frac, x.shape[:-2] + frac.shape[-1:])
+    cell_mean = np.einsum('...tp,...p->...t', x, frac)
+    missing = np.isnan(cell_mean)
+    if missing.any():
+        empty = np.isnan(np.fmax.reduce(x, axis=(-2, -1))) # no value at any time and PFT
+        cell_mean[empty] = 0
+        missing[empty] = False
+        if missing.any():
+            idx = np.nonzero(missing)
+            cell_mean[missing] = np.nansum(x[idx]*frac[idx[:-1]], axis=-1)
+    cell_mean = cell_mean*scale if scale.ndim == cell_mean.ndim else cell_mean*scale[..., None]
+    seas = np.where(np.isnan(cell_mean), 0, cell_mean) @ weights
+    seas[np.isnan(cell_mean[..., 0])] = np.nan # as in seasonal_clim
+    return seas
+
+# Seasonal climatology of the PFT-weighted mean, with PFT fractions and month weights contracted in one pass
+# Temporaries are of size time x cells (not time x lsmpft x cells); dask-backed input is evaluated lazily per spatial chunk
+def _pft_seasonal_mean(surf, variable, scale=None):
+    data = surf[variable]
+    frac = surf['pct_pft']/100
+    scale = xr.DataArray(1.) if scale is None else scale
+    if data.chunks is not None:
+        data = data.chunk({'time': -1, 'lsmpft': -1})
+        frac = frac.chunk({'lsmpft': -1})
+    seas = xr.apply_ufunc(
+        _pft_seasonal_kernel,
+        data, frac, season_weights(data['time']), scale,
+        input_core_dims=[['time', 'lsmpft'], ['lsmpft'], ['time', 'season'], ['time'] if 'time' in scale.dims else []],
+        output_core_dims=[['season']],
+        dask='parallelized',
+        output_dtypes=[np.result_type(data.dtype, frac.dtype, scale.dtype, float)],
+    )
+    seas = seas.where(surf['AREA'].notnull()) # set to nan instead of 0
+    seas = seas.transpose(*['season' if dim == 'time' else dim for dim in data.dims if dim != 'lsmpft']).assign_attrs(data.attrs) # season in place of time, as after groupby
+    seas.name = None # as for the product variable*pct_pft
     return seas
 
+# Weighted by PFT fractions
+def veg_seasonal_mean(surf, variable):
+    return _pft_seasonal_mean(surf, variable)
+
 # Weighted by PFT fractions and vegetated area (NATVEG+CROP)
 def gridcell_seasonal_mean(surf, variable):
-    with xr.set_options(keep_attrs=True): # to preserve the units
-        cell_mean = (surf[variable]*surf['pct_pft']/100).sum(dim='lsmpft') *(surf['PCT_NATVEG']+surf['PCT_CROP'])/100 # scale from vegetated to gridcell
-        seas = seasonal_clim(cell_mean)
-        seas = seas.where(surf['AREA'].notnull()) # set to nan instead of 0
-    return seas
+    return _pft_seasonal_mean(surf, variable, scale=(surf['PCT_NATVEG']+surf['PCT_CROP'])/100) # scale from vegetated to gridcell
 
 # Split rainfed and irrigated crop PFT on surface dataset
 def split_crop(surf):
@@ -82,29 +185,115 @@ def diff_masked(ds1, ds2, noise=10**-5):
 def masked(ds, noise=10**-5):
     return ds.where((ds < -noise) | (ds > noise))
 
+# Correlation engine: each variable is standardised once and all pairs are computed with matrix products over the
+# stacked dims (instead of one xr.corr per pair). NaNs are excluded pairwise and weights are used as in xr.corr
+# Dask-backed inputs stay lazy (the engine then builds a dask graph, computed with the result)
+def _corr_stack(das, batch_dims, dim, sizes):
+    dims = batch_dims + dim
+    shape = tuple(sizes[d] for d in dims)
+    if any(xr.core.utils.is_duck_dask_array(da.data) for da in das):
+        import dask.array as xp
+    else:
+        xp = np
+    values = [xp.broadcast_to(da.expand_dims([d for d in dims if d not in da.dims]).transpose(*dims).data, shape)
+              .reshape(shape[:len(batch_dims)] + (-1,)) for da in das]
+    return xp.stack(values, axis=-2).astype(float) # (..., variable, cells)
+
+def _corr_standardise(x, w):
+    valid = ~np.isnan(x)
+    w_valid = np.where(valid, w, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.where(valid, x, 0)
+        mean = (x*w_valid).sum(axis=-1, keepdims=True) / w_valid.sum(axis=-1, keepdims=True)
+        z = np.where(valid, x - mean, 0)
+        std = np.sqrt((z**2*w_valid).sum(axis=-1, keepdims=True) / w_valid.sum(axis=-1, keepdims=True))
+    z /= np.where((std > 0) & np.isfinite(std), std, 1) # scaling does not change the correlation, but keeps the sums well conditioned
+    return z, valid.astype(z.dtype)
+
+def _corr_engine(x1, x2, w, pairwise=True):
+    """
+    Correlations between the variables of x1 (..., n1, K) and x2 (..., n2, K) along the last axis, weights w (..., K).
+    Sums over the cells valid in both variables (joint masks) are matrix products of the standardised values and masks,
+    so that the result equals xr.corr per pair. pairwise=False correlates x1[i] with x2[i] only (n1 == n2).
+    """
+    z1, m1 = _corr_standardise(x1, w[..., None, :])
+    z2, m2 = _corr_standardise(x2, w[..., None, :])
+    z1w, m1w = z1*w[..., None, :], m1*w[..., None, :]
+    if pairwise:
+        prod = lambda a, b: a @ np.swapaxes(b, -1, -2)
+    else:
+        prod = lambda a, b: (a*b).sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        wsum = prod(m1w, m2)
+        mean1, mean2 = prod(z1w, m2)/wsum, prod(m1w, z2)/wsum
+        cov = prod(z1w, z2)/wsum - mean1*mean2
+        var1 = prod(z1w*z1, m2)/wsum - mean1**2
+        var2 = prod(m1w, z2**2)/wsum - mean2**2
+        corr = cov / np.sqrt(np.maximum(var1, 0)*np.maximum(var2, 0))
+    return corr
+
+def _corr_arrays(das1, das2, dim, weights, pairwise=True):
+    dim = [dim] if isinstance(dim, str) else list(dim)
+    aligned = xr.align(*das1, *das2, *([] if weights is None else [weights]), join='inner', copy=False)
+    das1, das2 = aligned[:len(das1)], aligned[len(das1):len(das1)+len(das2)]
+    sizes = dict()
+    for da in aligned:
+        sizes.update(da.sizes)
+    batch_dims = [d for d in sizes if d not in dim]
+    x1 = _corr_stack(das1, batch_dims, dim, sizes)
+    x2 = _corr_stack(das2, batch_dims, dim, sizes)
+    if weights is None:
+        w = np.ones(x1.shape[-1])
+    else:
+        w = _corr_stack([aligned[-1]], batch_dims, dim, sizes)[..., 0, :]
+    corr = _corr_engine(x1, x2, w, pairwise=pairwise)
+    return corr, das1, das2, batch_dims
+
+# Correlation of one pair as returned by xr.corr (dims of da1, then further dims of da2), from the engine output
+def _corr_pair(values, da1, da2, dim, batch_dims, weights=None):
+    dim = [dim] if isinstance(dim, str) else list(dim)
+    out_dims = [d for d in da1.dims if d not in dim] + [d for d in da2.dims if d not in da1.dims and d not in dim]
+    values = values[tuple(slice(None) if d in out_dims else 0 for d in batch_dims)]
+    values = np.transpose(values, [[d for d in batch_dims if d in out_dims].index(d) for d in out_dims])
+    coords = {**{k: c for k, c in da2.coords.items() if set(c.dims) <= set(out_dims)},
+              **{k: c for k, c in da1.coords.items() if set(c.dims) <= set(out_dims)}}
+    dtype = np.result_type(da1.dtype, da2.dtype, *([] if weights is None else [weights.dtype]))
+    return xr.DataArray(values.astype(dtype if np.issubdtype(dtype, np.floating) else float), coords=coords, dims=out_dims)
+
+# Correlation matrix between all variables of two datasets (or of one dataset with itself), dims (..., variable1, variable2)
+def corr_matrix(ds1, ds2=None, dim=['lat','lon'], weights=None):
+    ds2 = ds1 if ds2 is None else ds2
+    das1, das2 = list(ds1.data_vars.values()), list(ds2.data_vars.values())
+    corr, das1, das2, batch_dims = _corr_arrays(das1, das2, dim, weights)
+    coords = {'variable1': list(ds1.data_vars), 'variable2': list(ds2.data_vars)}
+    for da in das2 + das1:
+        coords.update({k: c for k, c in da.coords.items() if set(c.dims) <= set(batch_dims)})
+    return xr.DataArray(corr, coords=coords, dims=batch_dims + ['variable1', 'variable2'])
+
 # Correlation between array and each variable of a dataset
 def da_ds_corr(da1, ds2, dim=['lat','lon'], weights=None):
+    corr, das1, das2, batch_dims = _corr_arrays([da1], list(ds2.data_vars.values()), dim, weights)
     data_vars = dict()
-    for var, da2 in ds2.data_vars.items():
-        corr = xr.corr(da1, da2, dim=dim, weights=weights)
-        data_vars[var] = corr    
+    for j, var in enumerate(ds2.data_vars):
+        data_vars[var] = _corr_pair(corr[..., 0, j], das1[0], das2[j], dim, batch_dims, weights)
     return xr.Dataset(data_vars)
 
 # Correlation between each variable of two datasets
 def ds_ds_corr(ds1, ds2, dim=['lat','lon'], weights=None):
+    corr, das1, das2, batch_dims = _corr_arrays(list(ds1.data_vars.values()), list(ds2.data_vars.values()), dim, weights)
     data_vars = dict()
-    for var1, da1 in ds1.data_vars.items():
-        for var2, da2 in ds2.data_vars.items():
-            corr = xr.corr(da1, da2, dim=dim, weights=weights)
-            data_vars[var1, var2] = corr    
+    for i, var1 in enumerate(ds1.data_vars):
+        for j, var2 in enumerate(ds2.data_vars):
+            data_vars[var1, var2] = _corr_pair(corr[..., i, j], das1[i], das2[j], dim, batch_dims, weights)
     return xr.Dataset(data_vars)
 
 # Correlation between two datasets per variable (taking variables from ds1)
 def ds_corr(ds1, ds2, dim=['lat','lon'], weights=None):
+    variables = list(ds1.keys())
+    corr, das1, das2, batch_dims = _corr_arrays([ds1[var] for var in variables], [ds2[var] for var in variables], dim, weights, pairwise=False)
     data_vars = dict()
-    for var in list(ds1.keys()):
-        corr = xr.corr(ds1[var], ds2[var], dim=dim, weights=weights)
-        data_vars[var] = corr    
+    for i, var in enumerate(variables):
+        data_vars[var] = _corr_pair(corr[..., i], das1[i], das2[i], dim, batch_dims, weights)
     return xr.Dataset(data_vars)
 
 # Replace method for xarray using pandas (https://github.com/pydata/xarray/issues/6377)
@@ -120,16 +309,281 @@ def weighted_average(df, weights):
     wt = dataframe[weight]
     return (df * weights).sum() / wt.sum()
 
-# Compute confidence interval of the mean for a dataframe (variables in columns)
+# Compute confidence interval of the mean for a dataframe (variables in columns); groups may differ in size (see func_ci)
 def confidence_interval(df, group_dim=None, confidence=0.95):
-    from scipy import stats
-    if group_dim:
-        mean = df.groupby(group_dim).mean()
-        std = df.groupby(group_dim).std()
-        n = df.groupby(group_dim).size()[0] # assumes same number of elements within each group (here 15 years)
-    else:
-        mean = df.mean()
-        std = df.std()
-        n = len(df)
-    ci_upper = std/np.sqrt(n) * stats.t.ppf(1-(1-confidence)/2, n-1)
-    return ci_upper
\ No newline at end of file
+    from func_ci import confidence_interval
+    return confidence_interval(df, group_dim=group_dim, confidence=confidence)
+
+# Gross transitions between vegetation types per grid cell (values: cells x types, change in %)
+# Greedy filling from the most to the least gaining type, using the losses in descending order
+# Equivalent to overlapping the cumulative sums of sorted gains and sorted losses, so all cells are filled at once
+def transition_matrix(values):
+    values = np.asarray(values, dtype=float)
+    gains = np.where(values > 0, values, 0)
+    losses = np.where(values < 0, -values, 0)
+    order_gain = np.argsort(-gains, axis=-1, kind='stable') # descending, ties in order of types
+    order_loss = np.argsort(-losses, axis=-1, kind='stable')
+    gains = np.take_along_axis(gains, order_gain, axis=-1)
+    losses = np.take_along_axis(losses, order_loss, axis=-1)
+    gain_end, loss_end = np.cumsum(gains, axis=-1), np.cumsum(losses, axis=-1)
+    gain_start, loss_start = gain_end - gains, loss_end - losses
+
+    # Transfer from the j-th largest loss to the i-th largest gain: overlap of [start, end) intervals
+    transfer = np.minimum(gain_end[:, :, None], loss_end[:, None, :]) - np.maximum(gain_start[:, :, None], loss_start[:, None, :])
+    transfer = np.clip(transfer, 0, None)
+
+    # Back to type order: trans[cell, from, to]
+    cells = np.arange(values.shape[0])[:, None, None]
+    trans = np.zeros(values.shape + values.shape[-1:])
+    trans[cells, order_loss[:, None, :], order_gain[:, :, None]] = transfer
+    return trans
+
+# Net transitions per grid cell, with the dominant direction (summed over all cells) as label, e.g. 'Crop_to_Grass'
+# Cells are processed in chunks of chunk_size, which limits the memory of the cells x types x types transition matrices
+def calc_transitions(df, types, chunk_size=10000):
+    values = df[types].round(4).values # round as in the original per-cell loop
+    pairs = [(i, j) for i in range(len(types)) for j in range(i + 1, len(types))]
+    rows, cols = np.array(pairs).T
+    net = np.empty((len(values), len(pairs))) # forward - reverse
+    forward_sum, reverse_sum = np.zeros(len(pairs)), np.zeros(len(pairs))
+    for start in range(0, len(values), chunk_size):
+        trans = transition_matrix(values[start:start + chunk_size])
+        forward, reverse = trans[:, rows, cols], trans[:, cols, rows]
+        net[start:start + chunk_size] = forward - reverse
+        forward_sum += forward.sum(axis=0)
+        reverse_sum += reverse.sum(axis=0)
+    net_transition_dict = {}
+    for k, (i, j) in enumerate(pairs):
+        if forward_sum[k] >= reverse_sum[k]:
+            net_transition_dict[f"{types[i]}_to_{types[j]}"] = net[:, k]
+        else:
+            net_transition_dict[f"{types[j]}_to_{types[i]}"] = -net[:, k]
+    return pd.DataFrame(net_transition_dict, index=df.index)
+
+# Area-weighted regional means with a precomputed sparse weight matrix (regions x cells)
+# Replaces ds.weighted(mask_3D_eu*area.fillna(0)).mean(['lat','lon']), which broadcasts region x lat x lon weights for every call
+# Cells with missing data are excluded per value, as in xarray's weighted mean
+class RegionAggregator:
+    def __init__(self, area, mask_3D, eunis=None):
+        if eunis is not None: # combine EU+ and subregions into one mask (as in the notebooks)
+            eunis_mask = xr.where(eunis==1, True, False).rename('EU+')
+            eunis_mask = eunis_mask.expand_dims('region').assign_coords(region=['EU+'])
+            mask_3D = xr.concat([eunis_mask, mask_3D], dim='region')
+        weights = (mask_3D*area.fillna(0)).transpose('region', *area.dims)
+        self.dims = list(area.dims)
+        self.region = {name: coord for name, coord in weights.coords.items() if coord.dims == ('region',)} # region labels and other region coordinates
+        values = weights.values.reshape(weights.sizes['region'], -1)
+        self.cells = np.flatnonzero((values != 0).any(axis=0)) # flat index of cells in any region
+        self.weights = scipy.sparse.csr_matrix(values[:, self.cells])
+        self.sum_weights = self.weights.sum(axis=1).A1 # 0 for regions without cells
+        with np.errstate(divide='ignore'):
+            self.weights_norm = scipy.sparse.diags(1/self.sum_weights) @ self.weights # normalised per region, for gap-free data
+
+    # Weighted mean or sum of valid values; x has the spatial dims last
+    def _reduce(self, x, mean=True):
+        x = x.reshape(x.shape[:-len(self.dims)] + (-1,))[..., self.cells]
+        x = x.reshape(-1, x.shape[-1]).T # cells x other
+        valid = np.isfinite(x)
+        if valid.all():
+            out = (self.weights_norm if mean else self.weights) @ x
+            if mean: # the empty rows of weights_norm give 0
+                out = np.where(self.sum_weights[:, None] != 0, out, np.nan)
+        else:
+            out = self.weights @ np.where(valid, x, 0)
+            if mean:
+                sum_of_weights = self.weights @ valid.astype(float)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    out = np.where(sum_of_weights != 0, out/sum_of_weights, np.nan)
+        return out.T # other x regions
+
+    def _apply(self, obj, mean):
+        def func(x):
+            shape = x.shape[:-len(self.dims)]
+            return self._reduce(x, mean=mean).reshape(shape + (-1,))
+        out = xr.apply_ufunc(
+            func, obj,
+            input_core_dims=[self.dims],
+            output_core_dims=[['region']],
+            dask='parallelized',
+            output_dtypes=[float],
+            dask_gufunc_kwargs={'output_sizes': {'region': self.weights.shape[0]}},
+        )
+        return out.assign_coords(self.region)
+
+    # Weighted mean per region (Dataset or DataArray)
+    @profile
+    def mean(self, obj):
+        return self._apply(obj, mean=True)
+
+    # Weighted sum per region (Dataset or DataArray)
+    @profile
+    def sum(self, obj):
+        return self._apply(obj, mean=False)
+
+# Weighted quantiles along the last axis for many rows at once (data: rows x cells, weights: cells or rows x cells)
+# Same estimator as xarray's weighted quantile (linear method with Kish's effective sample size),
+# but only the tail containing the quantile is partitioned off and sorted instead of the full field
+def _weighted_quantile_rows(data, weights, q):
+    valid = ~np.isnan(data) & (weights != 0)
+    cols = valid.any(axis=tuple(range(valid.ndim - 1))) # drop cells that are missing everywhere (e.g., outside the land mask)
+    data, weights, valid = data[..., cols], np.broadcast_to(weights, valid.shape)[..., cols], valid[..., cols]
+    weights = np.where(valid, weights, 0.)
+    wsum = weights.sum(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nw = wsum**2 / (weights**2).sum(axis=-1, keepdims=True) # Kish's effective sample size
+        w_min = np.min(np.where(weights > 0, weights, np.inf), axis=-1, keepdims=True)
+    out = np.full((len(q),) + data.shape[:-1], np.nan)
+    if not (wsum > 0).any():
+        return out
+
+    for i, qi in enumerate(q):
+        h = np.clip((nw - 1)*qi + 1, 1, nw)
+        upper = qi > 0.5 # take the tail from the top
+        key = np.where(valid, -data if upper else data, np.inf)
+
+        # Smallest number of cells whose weight certainly covers the quantile position
+        tail = (nw - h + 1)/nw if upper else h/nw
+        with np.errstate(invalid='ignore'):
+            k = int(min(data.shape[-1], np.nanmax(np.ceil(tail*wsum/w_min)) + 1))
+        idx = np.argpartition(key, k - 1, axis=-1)[..., :k]
+        idx = np.take_along_axis(idx, np.take_along_axis(key, idx, axis=-1).argsort(axis=-1), axis=-1)
+        d = np.where(np.take_along_axis(valid, idx, axis=-1), np.take_along_axis(data, idx, axis=-1), 0.)
+        w = np.take_along_axis(weights, idx, axis=-1)/wsum
+
+        # Cumulative weights in ascending order of the data, starting with the weight below the tail
+        if upper:
+            d, w = d[..., ::-1], w[..., ::-1]
+            start = np.clip(1 - w.sum(axis=-1, keepdims=True), 0, None)
+        else:
+            start = np.zeros_like(wsum)
+        weights_cum = np.concatenate([start, start + np.cumsum(w, axis=-1)], axis=-1)
+
+        u = np.maximum((h - 1)/nw, np.minimum(h/nw, weights_cum))
+        v = u*nw - h + 1
+        out[i] = np.where(wsum[..., 0] > 0, (d*np.diff(v, axis=-1)).sum(axis=-1), np.nan)
+    return out
+
+# Weighted quantiles over dim (default: spatial) for all variables and remaining dims in one call
+@profile
+def weighted_quantile(ds, weights, q, dim=['lat','lon']):
+    q = np.atleast_1d(np.asarray(q, dtype=float))
+    weights = weights.fillna(0)
+    def func(x, w):
+        x = x.reshape(x.shape[:-len(dim)] + (-1,))
+        w = np.broadcast_to(w.reshape(w.shape[:-len(dim)] + (-1,)), x.shape)
+        return np.moveaxis(_weighted_quantile_rows(x, w, q), 0, -1)
+    out = xr.apply_ufunc(
+        func, ds, weights,
+        input_core_dims=[dim, dim],
+        output_core_dims=[['quantile']],
+        dask='parallelized',
+        output_dtypes=[float],
+        dask_gufunc_kwargs={'output_sizes': {'quantile': q.size}},
+    )
+    return out.assign_coords(quantile=q).transpose('quantile', ...)
+
+# Masks of the most affected area (lowest and highest frac of the area-weighted distribution) and the mean over those areas
+# Returns masks with region=['Min','Max'] (boolean, per case) and means with region=['Min','Max', 'Min <label>', 'Max <label>', ...],
+# where the additional regions use the masks of the reference cases (e.g., the hottest areas in SSP1) for all cases
+@profile
+def extreme_area(ds, area, frac=0.01, ref_cases={'SSP1': 'ssp1', 'SSP1−Recent': 'ssp1-recent'}, dim=['lat','lon']):
+    quantiles = weighted_quantile(ds, area, [frac, 1-frac], dim=dim)
+    masks = xr.concat([ds < quantiles.isel(quantile=0, drop=True),
+                       ds > quantiles.isel(quantile=1, drop=True)], dim='region').assign_coords(region=['Min','Max'])
+
+    # Unweighted mean over the masked cells (as in the notebooks)
+    def masked_mean(mask):
+        valid = mask & ds.notnull()
+        return ds.where(valid, 0).sum(dim)/valid.sum(dim)
+    means = [masked_mean(masks)]
+    for label, case in ref_cases.items():
+        if case in ds['case']:
+            means.append(masked_mean(masks.sel(case=case, drop=True)).assign_coords(region=[f'Min {label}', f'Max {label}']))
+    means = xr.concat(means, dim='region')
+    return masks, means
+
+# Perturbation levels of 3_sensitivity.ipynb (bins of pct_change in %); the outer bins are open-ended as in the notebook
+perturb_edges = [0, 10, 30, 50, 100]
+
+# Labels of the bins, e.g. '0-10%'
+def bin_labels(edges=perturb_edges):
+    return [f'{lo:g}-{hi:g}%' for lo, hi in zip(edges[:-1], edges[1:])]
+
+# Weighted quantiles along the last axis from one full sort (same estimator as _weighted_quantile_rows), cheaper for several quantiles
+def _weighted_quantile_sorted(data, weights, q):
+    valid = ~np.isnan(data) & (weights != 0)
+    order = np.argsort(np.where(valid, data, np.inf), axis=-1)
+    d = np.take_along_axis(np.where(valid, data, 0.), order, axis=-1)
+    w = np.take_along_axis(np.where(valid, weights, 0.), order, axis=-1)
+    wsum = w.sum(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nw = wsum**2 / (w**2).sum(axis=-1, keepdims=True) # Kish's effective sample size
+        weights_cum = np.concatenate([np.zeros_like(wsum), np.cumsum(w/wsum, axis=-1)], axis=-1)
+    out = np.full((len(q),) + data.shape[:-1], np.nan)
+    for i, qi in enumerate(q):
+        h = np.clip((nw - 1)*qi + 1, 1, nw)
+        u = np.maximum((h - 1)/nw, np.minimum(h/nw, weights_cum))
+        v = u*nw - h + 1
+        out[i] = np.where(wsum[..., 0] > 0, (d*np.diff(v, axis=-1)).sum(axis=-1), np.nan)
+    return out
+
+# Weights per (region, bin) group (sparse, groups x cells of the aggregator); cells with NaN in by are in no bin
+def _group_weights(aggregator, by, edges):
+    n_bins = len(edges) - 1
+    by = by.reshape(-1)[aggregator.cells]
+    codes = np.where(np.isnan(by), -1, np.digitize(by, edges[1:-1]))
+    weights = aggregator.weights.tocoo()
+    keep = codes[weights.col] >= 0
+    rows = weights.row[keep]*n_bins + codes[weights.col[keep]]
+    return scipy.sparse.csr_matrix((weights.data[keep], (rows, weights.col[keep])), shape=(weights.shape[0]*n_bins, weights.shape[1]))
+
+# Weighted means, counts of valid cells and weighted quantiles per (region, bin) for blocks with the spatial dims last
+# by may have leading dims of size 1 (broadcast) or of the same size as x (e.g., one pct_change map per case)
+def _binned_kernel(x, by, aggregator, edges, q):
+    n_dims, n_bins = len(aggregator.dims), len(edges) - 1
+    lead = np.broadcast_shapes(x.shape[:-n_dims], by.shape[:-n_dims])
+    x = np.broadcast_to(x, lead + x.shape[-n_dims:])
+    n_groups = aggregator.weights.shape[0]*n_bins
+    mean, count = np.full(lead + (n_groups,), np.nan), np.zeros(lead + (n_groups,))
+    quantiles = np.full(lead + (n_groups, len(q)), np.nan)
+    for i in np.ndindex(by.shape[:-n_dims]):
+        sel = tuple(j if size > 1 else slice(None) for j, size in zip(i, by.shape))
+        weights = _group_weights(aggregator, by[i], edges)
+        xs = x[sel].reshape(x[sel].shape[:-n_dims] + (-1,))[..., aggregator.cells]
+        other = xs.shape[:-1]
+        xs = xs.reshape(-1, xs.shape[-1]) # rows x cells
+        valid = np.isfinite(xs)
+        sums = weights @ np.where(valid, xs, 0).T
+        wsum = weights @ valid.T.astype(float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean[sel] = np.where(wsum != 0, sums/wsum, np.nan).T.reshape(other + (-1,))
+        count[sel] = ((weights != 0).astype(float) @ valid.T.astype(float)).T.reshape(other + (-1,))
+        for g in range(n_groups) if len(q) else []: # quantiles on the cells of each group only
+            start, end = weights.indptr[g], weights.indptr[g+1]
+            if end > start:
+                values = _weighted_quantile_sorted(xs[:, weights.indices[start:end]], weights.data[start:end], q)
+                quantiles[sel][..., g, :] = np.moveaxis(values, 0, -1).reshape(other + (len(q),))
+    shape = lead + (aggregator.weights.shape[0], n_bins)
+    return mean.reshape(shape), count.reshape(shape), quantiles.reshape(shape + (len(q),))
+
+# Area-weighted means, counts of valid cells and (optionally) area-weighted quantiles per perturbation bin and region in one pass
+# Replaces the masked copies per bin of 3_sensitivity.ipynb (clim, series); by is e.g. surf['pct_change'] (lat/lon, optionally per case)
+# aggregator: RegionAggregator (e.g., with eunis for EU+ and subregions); the bins are [edges[i], edges[i+1]), outer bins open-ended
+# Returns mean and count (dims ..., region, perturb) and quantiles (dims ..., region, perturb, quantile; None without q)
+@profile
+def binned_aggregate(ds, by, aggregator, edges=perturb_edges, q=None):
+    q = np.atleast_1d(np.asarray([] if q is None else q, dtype=float))
+    edges = np.asarray(edges, dtype=float)
+    mean, count, quantiles = xr.apply_ufunc(
+        _binned_kernel, ds, by,
+        input_core_dims=[aggregator.dims, aggregator.dims],
+        output_core_dims=[['region', 'perturb'], ['region', 'perturb'], ['region', 'perturb', 'quantile']],
+        kwargs={'aggregator': aggregator, 'edges': edges, 'q': q},
+        dask='parallelized',
+        output_dtypes=[float, float, float],
+        dask_gufunc_kwargs={'output_sizes': {'region': aggregator.weights.shape[0], 'perturb': len(edges) - 1, 'quantile': q.size}},
+    )
+    coords = {**aggregator.region, 'perturb': bin_labels(edges)}
+    mean, count = mean.assign_coords(coords), count.assign_coords(coords)
+    quantiles = quantiles.assign_coords(coords).assign_coords(quantile=q) if q.size else None
+    return mean, count, quantiles
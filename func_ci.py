@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+## Confidence intervals for all groups and columns at once (t-based and percentile)
+## Rows are sorted by group once; means and standard deviations come from one reduction, percentiles from one sort
+## Groups may have different sizes and NaN values are skipped per column (as in pandas)
+## Accepts pandas DataFrames (grouped by a column or index level) and xarray objects (reduced over a sample dim)
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy import stats
+
+# Percentiles of the two-sided interval (rounded as in the notebooks)
+def percentiles(confidence=0.95):
+    return np.round((1-confidence)/2, 4), np.round(1-(1-confidence)/2, 4)
+
+# Values as a block per group (groups x max group size x columns, padded with NaN) and the group labels
+def _group_blocks(values, groups):
+    codes, labels = pd.factorize(groups, sort=True) # sorted as in pandas groupby, also for mixed label types
+    order = np.argsort(codes, kind='stable')
+    sizes = np.bincount(codes, minlength=len(labels))
+    start = np.cumsum(sizes) - sizes
+    position = np.arange(len(codes)) - np.repeat(start, sizes) # position of each sorted row within its group
+    blocks = np.full((len(labels), sizes.max(initial=0), values.shape[1]), np.nan)
+    blocks[codes[order], position] = values[order]
+    return blocks, labels
+
+# Mean and t-based CI (half width) along the last axis, skipping NaN
+def _t_kernel(x, confidence=0.95):
+    n = np.isfinite(x).sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.nansum(x, axis=-1)/n
+        std = np.sqrt(np.nansum((x - mean[..., None])**2, axis=-1)/(n-1))
+        ci = std/np.sqrt(n) * stats.t.ppf(1-(1-confidence)/2, n-1)
+    return mean, ci
+
+# Percentiles along the last axis, skipping NaN (linear interpolation as pandas/numpy quantile)
+def _quantile_kernel(x, q):
+    x = np.sort(x, axis=-1) # NaN are sorted to the end
+    n = np.isfinite(x).sum(axis=-1)
+    out = []
+    for p in np.atleast_1d(q):
+        pos = p*np.maximum(n-1, 0)
+        lower = np.floor(pos).astype(int)
+        upper = np.minimum(lower+1, np.maximum(n-1, 0))
+        x_lower = np.take_along_axis(x, lower[..., None], axis=-1)[..., 0]
+        x_upper = np.take_along_axis(x, upper[..., None], axis=-1)[..., 0]
+        out.append(np.where(n > 0, x_lower + (pos-lower)*(x_upper-x_lower), np.nan))
+    return np.stack(out, axis=-1)
+
+# Values, group labels and column names of a DataFrame (group_dim: column or index level; None for one group)
+def _frame_values(df, group_dim):
+    if group_dim is None:
+        groups = np.zeros(len(df), dtype=int)
+    elif group_dim in df.columns:
+        groups = df[group_dim].to_numpy()
+    else:
+        groups = df.index.get_level_values(group_dim).to_numpy()
+    data = df.drop(columns=group_dim) if group_dim in df.columns else df
+    data = data.select_dtypes('number')
+    return data.to_numpy(dtype=float), groups, data.columns
+
+# Mean and t-based CI (half width) per group and column
+# DataFrame: grouped by group_dim (column or index level), returns DataFrames indexed by group (Series without group_dim)
+# xarray: reduced over dim, all other dims are kept as groups
+def mean_ci(obj, group_dim=None, dim='year', confidence=0.95):
+    if isinstance(obj, (xr.DataArray, xr.Dataset)):
+        return xr.apply_ufunc(_t_kernel, obj, input_core_dims=[[dim]], output_core_dims=[[], []],
+                              kwargs={'confidence': confidence}, dask='parallelized', output_dtypes=[float, float])
+    values, groups, columns = _frame_values(obj, group_dim)
+    blocks, labels = _group_blocks(values, groups)
+    mean, ci = _t_kernel(np.moveaxis(blocks, 1, -1), confidence)
+    if group_dim is None:
+        return pd.Series(mean[0], index=columns), pd.Series(ci[0], index=columns)
+    index = pd.Index(labels, name=group_dim)
+    return pd.DataFrame(mean, index=index, columns=columns), pd.DataFrame(ci, index=index, columns=columns)
+
+# t-based CI (half width) per group and column (see mean_ci)
+def confidence_interval(obj, group_dim=None, dim='year', confidence=0.95):
+    return mean_ci(obj, group_dim=group_dim, dim=dim, confidence=confidence)[1]
+
+# Percentile CI as deviation from the mean per group and column
+# DataFrame: lists [lower, upper] per group and column (format of the notebooks), xarray: new dim 'bound' (lower, upper)
+def confidence_interval_percentiles(obj, group_dim=None, dim='year', confidence=0.95):
+    q = percentiles(confidence)
+    if isinstance(obj, (xr.DataArray, xr.Dataset)):
+        def func(x):
+            return _quantile_kernel(x, q) - _t_kernel(x)[0][..., None]
+        out = xr.apply_ufunc(func, obj, input_core_dims=[[dim]], output_core_dims=[['bound']], dask='parallelized',
+                             output_dtypes=[float], dask_gufunc_kwargs={'output_sizes': {'bound': 2}})
+        return out.assign_coords(bound=['lower', 'upper'])
+    values, groups, columns = _frame_values(obj, group_dim)
+    blocks, labels = _group_blocks(values, groups)
+    blocks = np.moveaxis(blocks, 1, -1) # groups x columns x samples
+    ci = _quantile_kernel(blocks, q) - _t_kernel(blocks)[0][..., None]
+    index = pd.Index(labels, name=group_dim) if group_dim is not None else None
+    return pd.DataFrame([[list(c) for c in row] for row in ci.tolist()], index=index, columns=columns)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+## Functions for lazy loading of the scenario files
+## Files are opened with dask chunks; nothing is read until a result is computed
+## Files are read from the Zarr copy of the data directory if it exists (see convert_to_zarr)
+
+import os
+import glob
+import shutil
+import xarray as xr
+from settings import dpath_proc, dpath_zarr
+
+# Simulation directory per scenario
+scenarios = {'recent': 'cclm2_EUR11_FB_hist',
+             'ssp1': 'cclm2_EUR11_FB_ssp1',
+             'nfn': 'cclm2_EUR11_FB_nfn',
+             'nfs': 'cclm2_EUR11_FB_nfs',
+             'nac': 'cclm2_EUR11_FB_nac'}
+
+# Cases as used in the notebooks: single scenarios or differences "a-b"
+cases_clim = ['recent', 'ssp1', 'nfn-ssp1', 'nfs-ssp1', 'nac-ssp1', 'ssp1-recent']
+cases_series = ['recent', 'ssp1', 'nfn-ssp1', 'nfs-ssp1', 'nac-ssp1'] # SSP1-Recent cannot be calculated because of different years
+
+# Spatial chunks (412x424 grid in 4x4 blocks); time/season/year are kept in one chunk
+default_chunks = {'lat': 103, 'lon': 106}
+
+# Chunks of the Zarr copy: whole time axis per chunk, spatial blocks (ca. 2-5 MB per chunk for seasonal series)
+zarr_chunks = {'time': -1, 'lat': 103, 'lon': 106}
+
+# Zarr store corresponding to a NetCDF file (path relative to the data directory)
+def zarr_store(file, dpath_zarr=dpath_zarr):
+    return dpath_zarr + os.path.splitext(file)[0] + '.zarr'
+
+# Open a file lazily (path relative to the data directory), from the Zarr copy if it exists
+def open_file(file, chunks=default_chunks, dpath=dpath_proc, dpath_zarr=dpath_zarr):
+    store = zarr_store(file, dpath_zarr)
+    if os.path.isdir(store):
+        return xr.open_zarr(store, chunks=chunks, consolidated=True)
+    return xr.open_dataset(dpath + file, chunks=chunks)
+
+# Open a file with one variable (e.g., the region masks) as DataArray, as xr.open_dataarray, from the Zarr copy if it exists
+def open_dataarray(file, chunks=default_chunks, dpath=dpath_proc, dpath_zarr=dpath_zarr):
+    ds = open_file(file, chunks=chunks, dpath=dpath, dpath_zarr=dpath_zarr)
+    if len(ds.data_vars) != 1:
+        raise ValueError(f'{file} contains {len(ds.data_vars)} variables, open it with open_file.')
+    return ds[list(ds.data_vars)[0]]
+
+# Open one file of one scenario lazily, optionally only a subset of variables
+def open_scenario(scenario, file, variables=None, chunks=default_chunks, dpath=dpath_proc, dpath_zarr=dpath_zarr):
+    ds = open_file(scenarios[scenario] + '/' + file, chunks=chunks, dpath=dpath, dpath_zarr=dpath_zarr)
+    if variables is not None:
+        ds = ds[variables]
+    return ds
+
+# Combine scenarios and scenario differences along a new 'case' dimension (lazy)
+def open_cases(file, variables=None, cases=cases_series, mask=None, chunks=default_chunks, dpath=dpath_proc, dpath_zarr=dpath_zarr):
+    opened = dict() # each scenario is opened once, also if used in several cases
+    def scenario(name):
+        if name not in opened:
+            opened[name] = open_scenario(name, file, variables=variables, chunks=chunks, dpath=dpath, dpath_zarr=dpath_zarr)
+        return opened[name]
+
+    members = []
+    for case in cases:
+        if '-' in case:
+            case1, case2 = case.split('-')
+            members.append(scenario(case1) - scenario(case2))
+        else:
+            members.append(scenario(case))
+
+    ds = xr.concat(members, dim='case').assign_coords({'case': ('case', list(cases))})
+    if mask is not None:
+        ds = ds.where(mask) # e.g., eunis==1
+    return ds
+
+# Reduce a lazy dataset one variable and one case at a time, so that peak memory stays at one slice
+# func takes a DataArray and returns the reduced DataArray, e.g., lambda da: da.weighted(weights).mean(['lat','lon'])
+def stream_reduce(ds, func, dim='case'):
+    data_vars = dict()
+    for var in ds.data_vars:
+        parts = [func(ds[var].isel({dim: i})).compute() for i in range(ds.sizes[dim])]
+        data_vars[var] = xr.concat(parts, dim=ds[dim])
+    return xr.Dataset(data_vars)
+
+# One-time conversion of all NetCDF files under dpath into chunked, compressed Zarr stores with consolidated metadata
+# The directory tree is mirrored under dpath_zarr; existing stores are skipped unless overwrite=True
+def convert_to_zarr(dpath=dpath_proc, dpath_zarr=dpath_zarr, chunks=zarr_chunks, overwrite=False):
+    for path in sorted(glob.glob(dpath + '**/*.nc', recursive=True)):
+        file = os.path.relpath(path, dpath)
+        store = zarr_store(file, dpath_zarr)
+        if os.path.isdir(store) and not overwrite:
+            continue
+        with xr.open_dataset(path) as ds:
+            ds = ds.chunk({dim: chunks.get(dim, -1) for dim in ds.dims})
+            for var in ds.variables.values(): # drop NetCDF storage settings (chunksizes, zlib, ...), keep the decoding
+                var.encoding = {k: v for k, v in var.encoding.items() if k in ['dtype', '_FillValue', 'scale_factor', 'add_offset', 'units', 'calendar']}
+            os.makedirs(os.path.dirname(store), exist_ok=True)
+            ds.to_zarr(store + '.tmp', mode='w', consolidated=True) # write to a temporary store so that incomplete stores are never read
+        if os.path.isdir(store):
+            shutil.rmtree(store)
+        os.replace(store + '.tmp', store)
+        print(file, '->', store)
+
+if __name__ == '__main__':
+    convert_to_zarr()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+
+## Pipeline of the summary statistics (2_summary-tables.ipynb) as a graph of stages, run from the command line:
+##   python func_pipeline.py [stage ...] [--vars T_2M GPP] [--workers N] [--force] [--list]
+## A stage is declared as dict(func=..., kwargs={...}, deps=[...], inputs=[...], outputs=[...]) (like the figures of func_render):
+##   func(**kwargs) writes the outputs; deps are the stages whose outputs it reads, inputs the other files it reads
+## A stage is rebuilt only if its function, arguments, input files or the outputs of its dependencies changed (content hashes),
+## or if one of its outputs is missing; stages whose dependencies are done run concurrently in separate processes
+## Stages: masks -> aggregate_{var} -> significance_{var} -> tables -> figure_{var} (maps of the most affected areas) and further
+## figures declared for func_render (summary_stages(figures=...)), which are drawn in the worker processes
+## Aggregation and significance are separate stages per variable, so a change in one variable only reruns that variable and the tables
+
+import os
+import sys
+import argparse
+import traceback
+import contextlib
+import pandas as pd
+import xarray as xr
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from settings import dpath_proc
+from func_cache import cache_key
+from func_render import render_figure, init_worker, in_process, load_state, save_state
+from func_load import scenarios, open_cases, cases_clim, cases_series
+from func_calc import RegionAggregator, extreme_area
+from func_stats import xr_significance, summarize_stat_dim
+
+# ---- Engine ----
+
+# Stage names needed for targets (with all their dependencies), in topological order
+def _select(stages, targets=None):
+    order, visiting = [], set()
+    def visit(name):
+        if name in order:
+            return
+        if name not in stages:
+            raise KeyError(f"Unknown stage '{name}'.")
+        if name in visiting:
+            raise ValueError(f"Cycle in the dependencies of stage '{name}'.")
+        visiting.add(name)
+        for dep in stages[name].get('deps', []):
+            visit(dep)
+        visiting.discard(name)
+        order.append(name)
+    for name in (stages if targets is None else targets):
+        visit(name)
+    return order
+
+# Key of a stage: function, arguments, input files and the outputs of the dependencies
+def stage_key(name, stages, checksum=True):
+    spec = stages[name]
+    files = list(spec.get('inputs', [])) + [output for dep in spec.get('deps', []) for output in stages[dep]['outputs']]
+    return cache_key(spec['func'], (), spec.get('kwargs', {}), files=files, checksum=checksum)
+
+def _up_to_date(name, stages, state, checksum=True):
+    return state.get(name) == stage_key(name, stages, checksum) and all(os.path.exists(output) for output in stages[name]['outputs'])
+
+# Run one stage (in a worker process or in this process); figure stages are drawn and saved with func_render
+# The plotting backend and style are set once per worker process, in this process run_pipeline applies the style with in_process
+_figures_ready = False
+def _run_stage(spec, style=True, worker=True):
+    global _figures_ready
+    for output in spec['outputs']:
+        if os.path.dirname(output):
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+    if spec.get('figure', False):
+        if worker and not _figures_ready:
+            init_worker(style)
+            _figures_ready = True
+        return render_figure(spec)
+    spec['func'](**spec.get('kwargs', {}))
+    return spec['outputs']
+
+# Run the stages needed for targets (default: all), rebuilding only stale stages
+# Independent stages run in parallel processes (n_workers=1: in this process, e.g., for debugging)
+# Returns the status per stage: 'skipped' (up to date), 'built', 'not run' (failed dependency), or the error message
+def run_pipeline(stages, targets=None, n_workers=None, force=False, state_file='.pipeline_state.json', checksum=True, style=True):
+    names = _select(stages, targets)
+    state = load_state(state_file)
+    status = dict()
+    pending = list(names)
+    running = dict() # future: (name, key)
+
+    def done(name, key, error=None):
+        if error is None:
+            state[name] = key
+            status[name] = 'built'
+        else:
+            state.pop(name, None)
+            status[name] = error
+        save_state(state, state_file) # after each stage, so that an interrupted run can be resumed
+        print(f'{name}: {status[name]}')
+
+    def resolve(pool):
+        # Skip or start all stages whose dependencies are done; returns True if any stage was resolved
+        resolved = False
+        for name in list(pending):
+            deps = stages[name].get('deps', [])
+            if any(dep in status and status[dep] not in ('skipped', 'built') for dep in deps):
+                status[name] = 'not run'
+            elif all(status.get(dep) in ('skipped', 'built') for dep in deps):
+                try:
+                    key = stage_key(name, stages, checksum)
+                except OSError:
+                    status[name] = traceback.format_exc() # missing input file
+                else:
+                    if not force and state.get(name) == key and all(os.path.exists(output) for output in stages[name]['outputs']):
+                        status[name] = 'skipped'
+                    elif pool is None:
+                        try:
+                            _run_stage(stages[name], style, worker=False)
+                            done(name, key)
+                        except Exception:
+                            done(name, key, traceback.format_exc())
+                    else:
+                        running[pool.submit(_run_stage, stages[name], style)] = (name, key)
+                        pending.remove(name)
+                        resolved = True
+                        continue
+            else:
+                continue
+            pending.remove(name)
+            resolved = True
+        return resolved
+
+    if n_workers == 1:
+        figures = any(stages[name].get('figure', False) for name in names)
+        with in_process(style) if figures else contextlib.nullcontext():
+            while resolve(None):
+                pass
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            while resolve(pool) or running:
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, key = running.pop(future)
+                    try:
+                        future.result()
+                        done(name, key)
+                    except Exception:
+                        done(name, key, traceback.format_exc())
+    for name in pending: # only left with a cycle or an unknown dependency state
+        status[name] = 'not run'
+    return status
+
+# Status of the stages needed for targets without running them: 'up to date' or 'stale' (also if a dependency is stale)
+def pipeline_status(stages, targets=None, state_file='.pipeline_state.json', checksum=True):
+    state = load_state(state_file)
+    status = dict()
+    for name in _select(stages, targets):
+        deps_ok = all(status[dep] == 'up to date' for dep in stages[name].get('deps', []))
+        try:
+            fresh = deps_ok and _up_to_date(name, stages, state, checksum)
+        except OSError:
+            fresh = False
+        status[name] = 'up to date' if fresh else 'stale'
+    return status
+
+# Figures declared for func_render as stages (e.g., depending on 'tables')
+def figure_stages(figures, deps=()):
+    return {name: {**spec, 'figure': True, 'deps': list(deps) + spec.get('deps', [])} for name, spec in figures.items()}
+
+# ---- Stages of the summary statistics (2_summary-tables.ipynb) ----
+
+stat_vars = ['TXx', 'T_2M', 'TSOI_10CM', 'WIND_10M', 'PRECIP', 'TOTSOILWATER', 'SOILWATER_10CM', 'GPP']
+frac = 0.01 # fraction for calculation of most affected areas, here 1%
+seasons = ['DJF', 'MAM', 'JJA', 'SON']
+mask_files = ['surf.nc', 'eunis_mask_repr.nc', 'regionmask_3D_Dou.nc']
+
+# Files and names per variable: annual climatology and series, seasonal climatology and series (None: annual only)
+def var_files(var):
+    if var == 'TXx': # annual maximum of daily max temperature
+        return dict(source='TMAX_2M', annual=('cosmo_T2m-max-climatology.nc', 'cosmo_T2m-max-series.nc'), seasonal=None)
+    return dict(source=var, annual=('cclm2_annual-climatology.nc', 'cclm2_annual-series.nc'),
+                seasonal=('cclm2_seasonal-climatology.nc', 'cclm2_seasonal-series.nc'))
+
+# Intermediate files of one variable
+def var_outputs(var, path, frac=frac):
+    return {name: path + f'{var}/{name}_{frac}.nc' for name in ['mean', 'std', 'series_annual', 'series_seasonal', 'mask', 'sig']}
+
+# Area, EU+ mask and region masks in one file
+def prepare_masks(output, dpath=dpath_proc):
+    area = xr.open_dataset(dpath + scenarios['ssp1'] + '/surf.nc').AREA
+    eunis = xr.open_dataarray(dpath + 'eunis_mask_repr.nc')
+    mask_3D = xr.open_dataarray(dpath + 'regionmask_3D_Dou.nc')
+    xr.Dataset({'area': area, 'eunis': eunis, 'mask_3D': mask_3D}).to_netcdf(output)
+
+# Region means without the additional region coordinates (for concatenation with the Min/Max regions)
+def _region_labels(ds):
+    return ds.drop_vars([c for c in ds.coords if c != 'region' and 'region' in ds[c].dims])
+
+# Unweighted means over Min/Max masks of each case and of the reference cases (as extreme_area, for the series)
+def _masked_series(ds, masks, ref_cases={'SSP1': 'ssp1', 'SSP1−Recent': 'ssp1-recent'}, dim=['lat','lon']):
+    def masked_mean(mask):
+        valid = mask & ds.notnull()
+        return ds.where(valid, 0).sum(dim)/valid.sum(dim)
+    means = [masked_mean(masks.sel(case=ds['case']))]
+    for label, case in ref_cases.items():
+        means.append(masked_mean(masks.sel(case=case, drop=True)).assign_coords(region=[f'Min {label}', f'Max {label}']))
+    return xr.concat(means, dim='region')
+
+# Regional means of the climatology and of the series, including the most affected areas
+def _aggregate(clim, series, aggregator, area, frac, seasonal=False):
+    masks, extremes = extreme_area(clim, area, frac=frac)
+    mean = xr.concat([_region_labels(aggregator.mean(clim)), extremes], dim='region')
+    series_masks = masks.sel(season=series['time'].dt.season).drop_vars('season') if seasonal else masks
+    series = xr.concat([_region_labels(aggregator.mean(series)), _masked_series(series, series_masks)], dim='region')
+    return mean, series, masks
+
+# Aggregation stage of one variable: mean, std and regional series (annual and seasonal), and the Min/Max masks
+def aggregate_variable(var, masks, outputs, frac=frac, dpath=dpath_proc):
+    m = xr.open_dataset(masks)
+    aggregator = RegionAggregator(m.area, m.mask_3D, m.eunis)
+    files = var_files(var)
+    def load(file, cases):
+        ds = open_cases(file, variables=[files['source']], cases=cases, mask=m.eunis==1, chunks=None, dpath=dpath)
+        return ds.rename({files['source']: var})
+
+    mean, series, mask = _aggregate(load(files['annual'][0], cases_clim), load(files['annual'][1], cases_series), aggregator, m.area, frac)
+    means, stds, masks_all = [mean.expand_dims(season=['Annual'])], [series.std('year').expand_dims(season=['Annual'])], [mask.expand_dims(season=['Annual'])]
+    series.to_netcdf(outputs['series_annual'])
+    if files['seasonal'] is not None:
+        mean, series, mask = _aggregate(load(files['seasonal'][0], cases_clim), load(files['seasonal'][1], cases_series), aggregator, m.area, frac, seasonal=True)
+        means.append(mean)
+        stds.append(series.groupby('time.season').std('time'))
+        masks_all.append(mask)
+        series.to_netcdf(outputs['series_seasonal'])
+    else:
+        xr.Dataset().to_netcdf(outputs['series_seasonal']) # annual only
+    xr.concat(means, dim='season').to_netcdf(outputs['mean'])
+    xr.concat(stds, dim='season').to_netcdf(outputs['std'])
+    xr.concat(masks_all, dim='season').to_netcdf(outputs['mask'])
+
+# Significance stage of one variable: paired tests of the scenario differences and independent test SSP1 vs. Recent
+# FDR per case across regions (and seasons)
+def significance_variable(var, series_annual, series_seasonal, output, method='batched'):
+    paired = ['nfn-ssp1', 'nfs-ssp1', 'nac-ssp1']   # Wilcoxon on differences
+    independent = [('ssp1', 'recent')]              # M–W U on raw cases
+    sig = [xr_significance(xr.open_dataset(series_annual), test_dim='year', paired_samples=paired, independent_samples=independent,
+                           multitest=True, method=method).expand_dims(season=['Annual'])]
+    seasonal = xr.open_dataset(series_seasonal)
+    if var in seasonal:
+        seasonal = seasonal.assign_coords(season=('time', seasonal['time'].dt.season.values))
+        sig.append(xr_significance(seasonal, test_dim='time', split_dim='season', paired_samples=paired, independent_samples=independent,
+                                   multitest=True, method=method))
+    sig = xr.concat(sig, dim='season').sel(variable=var, drop=True)
+    xr.concat([sig['statistic'], sig['p'], sig['effect_size']], dim='stat').assign_coords(stat=['statistic', 'p', 'effect_size']).rename(var).to_netcdf(output)
+
+# Table of mean ± std and significance per season (Tables/SuppData3_statistics_{frac}.xlsx of the notebook)
+# Rows are the variables of the notebook's table; other variables (e.g., TOTSOILWATER) are only in the climStats files
+def statistics_table(mean, std, sig, frac, output):
+    row_headers = {'TXx': 'Max air temperature at 2m (TXx, °C)', 'T_2M': 'Air temperature at 2m (°C)', 'TSOI_10CM': 'Soil temperature 0-10cm (°C)',
+                   'WIND_10M': 'Wind speed at 10m (m s−¹)', 'PRECIP': 'Precipitation (mm day−¹)', 'SOILWATER_10CM': 'Soil moisture 0-10cm (mm)',
+                   'GPP': 'Gross primary production (GPP, g C m−² day−¹)'}
+    columns = {'recent': 'Recent', 'ssp1': 'SSP1', 'nfn-ssp1': 'NfN−SSP1', 'nfs-ssp1': 'NfS−SSP1', 'nac-ssp1': 'NaC−SSP1', 'ssp1-recent': 'SSP1−Recent'}
+    sig = summarize_stat_dim(sig, stat_dim='stat', blank_cases=['recent', 'ssp1'], nan_label='')
+    with pd.ExcelWriter(output, mode='w') as writer:
+        for seas in ['Annual'] + seasons:
+            table_mean = mean.to_array().to_dataset('case').sel(season=seas, drop=True).to_dataframe()
+            table_std = std.to_array().to_dataset('case').sel(season=seas, drop=True).to_dataframe().reindex(columns=table_mean.columns)
+            table_sig = sig.to_array().to_dataset('case').sel(season=seas, drop=True).to_dataframe().reindex(columns=table_mean.columns, fill_value='')
+            table_print = table_mean.map('{0:.2f}'.format) + ' ± ' + table_std.map('{0:.2f}'.format) + ' ' + table_sig.fillna('')
+            table_print['ssp1-recent'] = table_mean['ssp1-recent'].map('{0:.2f}'.format) + ' ' + table_sig['ssp1-recent'].fillna('') # only the multi-year mean
+            table_print = table_print[table_mean.notnull().any(axis=1)] # e.g., TXx in seasons
+            table_print = table_print.reindex([v for v in row_headers if v in mean], level=0).rename(index=row_headers)
+            table_print = table_print.rename(index={'Min': f'Min affected {int(frac*100)}%', 'Max': f'Max affected {int(frac*100)}%'}, level=1)
+            table_print.rename(columns=columns).to_excel(writer, sheet_name=seas)
+
+# Tables stage: combined climStats files (as written by the notebook, read by the other notebooks) and the statistics table
+def write_tables(variables, path, outputs, frac=frac):
+    files = {var: var_outputs(var, path, frac) for var in variables}
+    mean = xr.merge([xr.open_dataset(files[var]['mean']) for var in variables], join='outer')
+    std = xr.merge([xr.open_dataset(files[var]['std']) for var in variables], join='outer')
+    sig = xr.merge([xr.open_dataarray(files[var]['sig']) for var in variables], join='outer')
+    masks = xr.merge([xr.open_dataset(files[var]['mask']) for var in variables], join='outer')
+    mean.to_netcdf(outputs['mean'])
+    std.to_netcdf(outputs['std'])
+    sig.to_netcdf(outputs['sig'])
+    masks.sel(region='Min', drop=True).astype(float).where(lambda x: x > 0).to_netcdf(outputs['mask_min']) # NaN outside for plotting
+    masks.sel(region='Max', drop=True).astype(float).where(lambda x: x > 0).to_netcdf(outputs['mask_max'])
+    statistics_table(mean, std, sig, frac, outputs['table'])
+
+# Figure stage: maps of the least (Min) and most (Max) affected areas of one variable and season per case (climMask files)
+def mask_figure(mask_min, mask_max, var, frac=frac, season='Annual', cases=['nfn-ssp1', 'nfs-ssp1', 'nac-ssp1']):
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as colors
+    from plotting import double_width
+    from func_plots import map_proj, map_pcolormesh, format_axes
+    masks = {'Min': xr.open_dataset(mask_min)[var], 'Max': xr.open_dataset(mask_max)[var]}
+    fig, axes = plt.subplots(2, len(cases), figsize=(double_width, 3.5), subplot_kw={'projection': map_proj}, squeeze=False)
+    for row, (label, color) in zip(axes, [('Min', 'tab:blue'), ('Max', 'tab:red')]):
+        for ax, case in zip(row, cases):
+            map_pcolormesh(ax, masks[label].sel(season=season, case=case), cmap=colors.ListedColormap([color]), vmin=0, vmax=1)
+            ax.set_title(f'{label} {case} ({season})')
+        format_axes(row)
+    fig.suptitle(f'{var}: Min/Max affected {int(frac*100)}%') # as in the statistics table
+    return fig
+
+# Stages of the summary statistics for the given variables
+# figures: further figures {name: spec} as declared for func_render, built after the tables; figure_path=None: no mask figures
+def summary_stages(variables=stat_vars, frac=frac, dpath=dpath_proc, path=None, tables_path='Tables/', method='batched',
+                   figure_path='Figures/climStats/', figures=None):
+    path = dpath + 'climStats/' if path is None else path
+    stages = {'masks': dict(func=prepare_masks, kwargs=dict(output=path + 'masks.nc', dpath=dpath),
+                            inputs=[dpath + scenarios['ssp1'] + '/surf.nc'] + [dpath + f for f in mask_files[1:]],
+                            outputs=[path + 'masks.nc'])}
+    for var in variables:
+        files, outputs = var_files(var), var_outputs(var, path, frac)
+        data = [f for period in ['annual', 'seasonal'] if files[period] for f in files[period]]
+        stages[f'aggregate_{var}'] = dict(
+            func=aggregate_variable, kwargs=dict(var=var, masks=path + 'masks.nc', outputs=outputs, frac=frac, dpath=dpath),
+            deps=['masks'], inputs=[dpath + scenarios[s] + '/' + f for s in scenarios for f in data],
+            outputs=[outputs[name] for name in ['mean', 'std', 'series_annual', 'series_seasonal', 'mask']])
+        stages[f'significance_{var}'] = dict(
+            func=significance_variable, kwargs=dict(var=var, series_annual=outputs['series_annual'], series_seasonal=outputs['series_seasonal'],
+                                                    output=outputs['sig'], method=method),
+            deps=[f'aggregate_{var}'], outputs=[outputs['sig']])
+    outputs = dict(mean=path + f'climStats_mean_{frac}.nc', std=path + f'climStats_std_{frac}.nc', sig=path + f'climStats_sig_{frac}.nc',
+                   mask_min=path + f'climMask_min_{frac}.nc', mask_max=path + f'climMask_max_{frac}.nc',
+                   table=tables_path + f'SuppData3_statistics_{frac}.xlsx')
+    stages['tables'] = dict(func=write_tables, kwargs=dict(variables=list(variables), path=path, outputs=outputs, frac=frac),
+                            deps=[f'{step}_{var}' for var in variables for step in ['aggregate', 'significance']],
+                            outputs=list(outputs.values()))
+    if figure_path is not None:
+        stages.update(figure_stages({f'figure_{var}': dict(
+            func=mask_figure, kwargs=dict(mask_min=outputs['mask_min'], mask_max=outputs['mask_max'], var=var, frac=frac),
+            outputs=[figure_path + f'climMask_{var}_{frac}.png']) for var in variables}, deps=['tables']))
+    stages.update(figure_stages(figures or {}, deps=['tables']))
+    return stages
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the stages of the summary statistics, rebuilding only stale outputs.')
+    parser.add_argument('targets', nargs='*', help='stages to build with their dependencies (default: all)')
+    parser.add_argument('--vars', nargs='+', default=stat_vars, help='variables')
+    parser.add_argument('--frac', type=float, default=frac, help='fraction of the most affected area')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (1: run in this process)')
+    parser.add_argument('--force', action='store_true', help='rebuild the selected stages even if up to date')
+    parser.add_argument('--list', action='store_true', help='show the status of the stages without running them')
+    parser.add_argument('--state', default='.pipeline_state.json', help='file with the keys of the built stages')
+    parser.add_argument('--no-figures', action='store_true', help='stop after the tables')
+    args = parser.parse_args(argv)
+
+    stages = summary_stages(variables=args.vars, frac=args.frac, figure_path=None if args.no_figures else 'Figures/climStats/')
+    targets = args.targets or None
+    if args.list:
+        for name, status in pipeline_status(stages, targets, state_file=args.state).items():
+            print(f'{name}: {status}')
+        return 0
+    status = run_pipeline(stages, targets, n_workers=args.workers, force=args.force, state_file=args.state)
+    return int(any(s not in ('skipped', 'built') for s in status.values()))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,12 +3,19 @@
 ## Plotting functions
 ## Petra Sieber, Dec 2025
 
+import os
+import functools
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
+import matplotlib.collections as mcollections
+import matplotlib.contour as mcontour
+import shapely.geometry as sgeom
 import cartopy.crs as ccrs
 import cartopy.feature as cf
+from func_cache import cache_key, memoize
+from settings import dpath_cache
 
 # Plotting settings
 lonmin, lonmax, latmin, latmax = [-11, 37, 35, 70.5]                   # window for plotting
@@ -16,11 +23,237 @@ set_lonmin, set_lonmax, set_latmin, set_latmax = [-35, 65, 30, 72.6]   # subset
 data_proj = ccrs.PlateCarree()
 map_proj = ccrs.LambertConformal(central_longitude=15) # for regional maps
 
+# Coastlines and country borders projected to map_proj and clipped to the plotting window
+# Computed once per process (the same for every map panel), instead of reprojecting the features on each axis
+@functools.lru_cache(maxsize=None)
+def map_features(coast_resolution='50m', border_resolution=None):
+    # Window in map coordinates, as in ax.set_extent (bounding box of the projected lon/lat window), with a small margin
+    x0, x1, y0, y1 = _map_window()
+    window = sgeom.box(x0, y0, x1, y1)
+    # Lon/lat region covering the window (wider than the lon/lat window towards the corners)
+    xs = np.concatenate([np.linspace(x0, x1, 50), np.full(50, x1), np.linspace(x1, x0, 50), np.full(50, x0)])
+    ys = np.concatenate([np.full(50, y0), np.linspace(y0, y1, 50), np.full(50, y1), np.linspace(y1, y0, 50)])
+    lonlat = data_proj.transform_points(map_proj, xs, ys)
+    extent = [lonlat[:, 0].min() - 1, lonlat[:, 0].max() + 1, lonlat[:, 1].min() - 1, lonlat[:, 1].max() + 1]
+
+    if border_resolution is None: # as selected by cartopy for cf.BORDERS when drawing this window
+        border_resolution = cf.BORDERS.scaler.scale_from_extent(extent)
+
+    features = dict()
+    for name, feature in [('coastline', cf.COASTLINE.with_scale(coast_resolution)), ('borders', cf.BORDERS.with_scale(border_resolution))]:
+        geoms = [map_proj.project_geometry(geom, data_proj) for geom in feature.intersecting_geometries(extent)]
+        geoms = [geom.intersection(window) for geom in geoms if not geom.is_empty]
+        features[name] = [geom for geom in geoms if not geom.is_empty]
+    return features
+
+def _map_window(margin=0.02):
+    x0, y0, x1, y1 = map_proj.project_geometry(sgeom.box(lonmin, latmin, lonmax, latmax), data_proj).bounds
+    dx, dy = margin*(x1 - x0), margin*(y1 - y0)
+    return x0 - dx, x1 + dx, y0 - dy, y1 + dy
+
+# Cell boundaries along one axis: midpoints between the cell centres, extrapolated at the edges (as in xarray's pcolormesh)
+def _cell_breaks(x, axis):
+    deltas = 0.5*np.diff(x, axis=axis)
+    first = np.take(x, [0], axis) - np.take(deltas, [0], axis)
+    last = np.take(x, [-1], axis) + np.take(deltas, [-1], axis)
+    return np.concatenate([first, np.take(x, range(x.shape[axis] - 1), axis) + deltas, last], axis=axis)
+
+# Cell corners (lat+1, lon+1) of a regular grid with 1D lon/lat or a rotated grid with 2D lon/lat
+def _cell_corners(lon, lat):
+    if lon.ndim == 1:
+        return np.meshgrid(_cell_breaks(lon, 0), _cell_breaks(lat, 0))
+    return [_cell_breaks(_cell_breaks(c, 1), 0) for c in [lon, lat]]
+
+# Projected cell corners; projection (proj4 string of map_proj) is only used for the cache key
+def _project_mesh(lon, lat, projection):
+    lon_c, lat_c = _cell_corners(lon, lat)
+    xy = map_proj.transform_points(data_proj, lon_c, lat_c)
+    return xy[..., 0], xy[..., 1]
+
+# Flat index of the grid cell (nearest centre) for each pixel of a regular (ny, nx) image of the map window, -1 outside the grid
+def _raster_index(lon, lat, projection, shape):
+    from scipy.spatial import cKDTree
+    from matplotlib.path import Path
+    if lon.ndim == 1:
+        lon, lat = np.meshgrid(lon, lat)
+    centres = map_proj.transform_points(data_proj, lon, lat)[..., :2].reshape(-1, 2)
+    x0, x1, y0, y1 = _map_window()
+    ny, nx = shape
+    xs = x0 + (np.arange(nx) + 0.5)*(x1 - x0)/nx
+    ys = y0 + (np.arange(ny) + 0.5)*(y1 - y0)/ny
+    pixels = np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2)
+    index = cKDTree(centres).query(pixels)[1]
+    # Pixels outside the outer boundary of the grid (ring of corners)
+    xc, yc = _project_mesh(lon, lat, projection)
+    ring = [(c[0, :], c[1:, -1], c[-1, -2::-1], c[-2:0:-1, 0]) for c in [xc, yc]]
+    boundary = Path(np.stack([np.concatenate(ring[0]), np.concatenate(ring[1])], axis=-1))
+    index[~boundary.contains_points(pixels)] = -1
+    return index.reshape(shape)
+
+_grids = dict() # projected meshes and raster indices per grid, in memory of this process
+
+# Cache directory if it can be written, else None (no caching)
+def _writable(cache_dir):
+    if cache_dir is None:
+        return None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        return None
+    return cache_dir if os.access(cache_dir, os.W_OK) else None
+
+# Projected mesh or raster index of a grid, computed once per grid and stored in the cache directory (func_cache)
+def _grid_cached(func, *args, cache_dir=dpath_cache):
+    key = cache_key(func, args)
+    if key not in _grids:
+        _grids[key] = memoize(cache_dir=_writable(cache_dir))(func)(*args) # computed once, also without cache directory
+    return _grids[key]
+
+# Cell corners (x, y) of a lon/lat grid projected to map_proj, e.g., for ax.pcolormesh(x, y, values, transform=map_proj)
+# Projecting the ~170k cells of the EUR-11 grid is the same for every panel and variable, so it is done once per grid
+def projected_mesh(lon, lat, cache_dir=dpath_cache):
+    lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+    return _grid_cached(_project_mesh, lon, lat, map_proj.proj4_init, cache_dir=cache_dir)
+
+# Colormap, norm and extend from the colour options of xarray's plot functions, in the order of xarray's _determine_cmap_params
+# (limits from the data or the 2nd/98th percentiles with robust, symmetric around center if diverging, discrete with levels or colors)
+def _color_mapping(values, vmin=None, vmax=None, cmap=None, colors=None, center=None, robust=False, extend=None, levels=None, norm=None):
+    if colors is not None:
+        if cmap is not None:
+            raise ValueError("Can't specify both cmap and colors.")
+        if levels is None:
+            raise ValueError('Can only specify colors with levels.')
+        cmap = [colors] if isinstance(colors, str) else colors
+    if levels is not None and not np.isscalar(levels):
+        levels = sorted(levels)
+    data = values[np.isfinite(values)]
+    data = data if data.size else np.array([0.0]) # all NaN
+    # Diverging unless center=False or both limits are given; a single limit sets the half range
+    possibly_divergent = center is not False and not (vmin is not None and vmax is not None)
+    center_is_none = center is None or center is False
+    center = 0.0 if center_is_none else center
+    user_minmax = vmin is not None or vmax is not None
+    vmin_was_none, vmax_was_none = vmin is None, vmax is None
+    vlim = None
+    if vmin is None:
+        vmin = np.percentile(data, 2) if robust else data.min()
+    elif possibly_divergent:
+        vlim = abs(vmin - center)
+    if vmax is None:
+        vmax = np.percentile(data, 98) if robust else data.max()
+    elif possibly_divergent:
+        vlim = abs(vmax - center)
+    levels_are_divergent = levels is not None and not np.isscalar(levels) and levels[0]*levels[-1] < 0
+    divergent = possibly_divergent and (vmin < 0 < vmax or not center_is_none or levels_are_divergent)
+    if divergent:
+        vlim = max(abs(vmin - center), abs(vmax - center)) if vlim is None else vlim
+        vmin, vmax = -vlim, vlim
+    vmin, vmax = vmin + center, vmax + center
+    # A norm keeps its own limits (and gets the computed ones where unset)
+    if norm is not None:
+        if norm.vmin is None:
+            norm.vmin = vmin
+        elif not vmin_was_none and vmin != norm.vmin:
+            raise ValueError('Cannot supply vmin and a norm with a different vmin.')
+        vmin = norm.vmin
+        if norm.vmax is None:
+            norm.vmax = vmax
+        elif not vmax_was_none and vmax != norm.vmax:
+            raise ValueError('Cannot supply vmax and a norm with a different vmax.')
+        vmax = norm.vmax
+    if isinstance(norm, mpl.colors.BoundaryNorm):
+        levels = norm.boundaries
+    if cmap is None:
+        cmap = 'RdBu_r' if divergent else 'viridis'
+    if levels is not None:
+        if np.isscalar(levels):
+            if user_minmax:
+                levels = np.linspace(vmin, vmax, levels)
+            elif levels == 1:
+                levels = np.asarray([(vmin + vmax)/2])
+            else:
+                levels = mpl.ticker.MaxNLocator(levels - 1).tick_values(vmin, vmax) # N of MaxNLocator counts bins
+        vmin, vmax = levels[0], levels[-1]
+    if vmin == vmax:
+        vmin, vmax = mpl.ticker.LinearLocator(2).tick_values(vmin, vmax)
+    if extend is None:
+        extend = {(False, False): 'neither', (True, False): 'min', (False, True): 'max', (True, True): 'both'}[
+            (data.min() < vmin, data.max() > vmax)]
+    if levels is not None and not isinstance(norm, mpl.colors.BoundaryNorm):
+        cmap, discrete_norm = _discrete_cmap(cmap, levels, extend)
+        norm = discrete_norm if norm is None else norm
+    else:
+        cmap = plt.get_cmap(cmap)
+    if norm is None:
+        norm = mpl.colors.Normalize(vmin, vmax)
+    return cmap, norm, extend
+
+# Discrete colormap and norm for levels; colour lists are repeated or truncated to the number of intervals (with extensions),
+# colormaps are sampled at the intervals, and changed bad/under/over colours of a colormap are kept
+def _discrete_cmap(cmap, levels, extend):
+    levels = [levels[0], levels[0]] if len(levels) == 1 else levels
+    n_colors = len(levels) - 1 + {'both': 2, 'min': 1, 'max': 1}.get(extend, 0)
+    if isinstance(cmap, str) and cmap not in mpl.colormaps:
+        cmap = [cmap] # one colour
+    if isinstance(cmap, (list, tuple)):
+        palette = [cmap[i % len(cmap)] for i in range(n_colors)]
+    else:
+        palette = plt.get_cmap(cmap)(np.linspace(0, 1, n_colors))
+    new_cmap, norm = mpl.colors.from_levels_and_colors(levels, palette, extend=extend)
+    if isinstance(cmap, mpl.colors.Colormap):
+        under, over = cmap(-np.inf), cmap(np.inf)
+        new_cmap = new_cmap.with_extremes(bad=cmap(np.nan), under=None if under == cmap(0) else under,
+                                          over=None if over == cmap(cmap.N - 1) else over)
+    return new_cmap, norm
+
+# Colorbar label from the attributes (long_name or standard_name or name, and units)
+def _label(da):
+    name = da.attrs.get('long_name', da.attrs.get('standard_name', da.name or ''))
+    units = da.attrs.get('units')
+    return f'{name} [{units}]' if units else name
+
+# Map of a lon/lat field on map_proj axes, replacing da.plot(ax=ax, transform=data_proj, **opt)
+# Draws on the cached projected mesh, without reprojection by cartopy; colour options (vmin, vmax, levels, extend, cmap, colors, norm,
+# center, robust) are processed as in xarray (with matplotlib, see _color_mapping), no title is set
+# raster: draw an image of the map window with this width (pixels, e.g., 300), each pixel coloured by the nearest grid cell,
+# for thumbnails and quick-looks (fast to draw and small in vector formats)
+def map_pcolormesh(ax, da, x='lon', y='lat', raster=None, add_colorbar=False, cbar_kwargs=None, cache_dir=dpath_cache, **kwargs):
+    if getattr(ax, 'projection', None) != map_proj:
+        return da.plot(ax=ax, x=x, y=y, transform=kwargs.pop('transform', data_proj), add_colorbar=add_colorbar, cbar_kwargs=cbar_kwargs, **kwargs)
+    kwargs.pop('transform', None) # lon/lat coordinates
+    lon, lat = np.asarray(da[x], dtype=float), np.asarray(da[y], dtype=float)
+    values = da.transpose(*(da[x].dims if lon.ndim == 2 else da[y].dims + da[x].dims)).values.astype(float)
+
+    cmap_opts = {k: kwargs.pop(k) for k in ['vmin', 'vmax', 'cmap', 'colors', 'center', 'robust', 'extend', 'levels', 'norm'] if k in kwargs}
+    cmap, norm, extend = _color_mapping(values, **cmap_opts)
+    opts = dict(cmap=cmap, norm=norm, **kwargs)
+
+    if raster:
+        x0, x1, y0, y1 = _map_window()
+        shape = (int(round(raster*(y1 - y0)/(x1 - x0))), int(raster))
+        index = _grid_cached(_raster_index, lon, lat, map_proj.proj4_init, shape, cache_dir=cache_dir)
+        image = np.where(index >= 0, values.ravel()[index], np.nan)
+        h = mpl.axes.Axes.imshow(ax, np.ma.masked_invalid(image), extent=(x0, x1, y0, y1), origin='lower', interpolation='nearest', **opts)
+    else:
+        xc, yc = projected_mesh(lon, lat, cache_dir=cache_dir)
+        h = mpl.axes.Axes.pcolormesh(ax, xc, yc, np.ma.masked_invalid(values), shading='flat', **opts)
+    if add_colorbar:
+        cbar_kwargs = dict(cbar_kwargs or {})
+        cbar_kwargs.setdefault('extend', extend)
+        cbar_kwargs.setdefault('label', _label(da))
+        ax.figure.colorbar(h, ax=ax, **cbar_kwargs)
+    return h
+
 # Regional plot with coastline and country borders
 def format_axes(axes, single=False):
     def format_ax(ax):
-        ax.coastlines(resolution='50m', linewidth=0.45)
-        ax.add_feature(cf.BORDERS, linewidth=0.3)
+        if ax.projection == map_proj: # pre-projected features
+            features = map_features()
+            ax.add_geometries(features['coastline'], crs=map_proj, facecolor='none', edgecolor='black', linewidth=0.45)
+            ax.add_geometries(features['borders'], crs=map_proj, facecolor='none', edgecolor='black', linewidth=0.3)
+        else:
+            ax.coastlines(resolution='50m', linewidth=0.45)
+            ax.add_feature(cf.BORDERS, linewidth=0.3)
         ax.set_extent([lonmin, lonmax, latmin, latmax], crs=data_proj)
         ax.gridlines(draw_labels=False, linewidth=0.3, color="gray", xlocs=range(-180, 180, 10), ylocs=range(-90, 90, 10))
     if single:
@@ -29,6 +262,17 @@ def format_axes(axes, single=False):
         for i, ax in enumerate(axes):
             format_ax(ax)
 
+# Rasterize dense layers (pcolormesh, filled contours, large polygon collections) for vector output (PDF, SVG),
+# so that files stay small and fast to render; text, lines and features stay vector
+def rasterize_dense(fig, min_paths=1000):
+    for ax in fig.get_axes():
+        for artist in ax.get_children():
+            if isinstance(artist, (mcollections.QuadMesh, mcontour.ContourSet)):
+                artist.set_rasterized(True)
+            elif isinstance(artist, mcollections.PolyCollection) and len(artist.get_paths()) >= min_paths:
+                artist.set_rasterized(True)
+    return fig
+
 # Add row and column headers (based on https://stackoverflow.com/a/25814386)
 def add_headers(fig, *, row_headers=None, col_headers=None, row_pad=1, col_pad=4, rotate_row_headers=True, **text_kwargs):
     axes = fig.get_axes()
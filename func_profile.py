@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+## Opt-in profiling of the analysis functions (time, memory, array sizes and dask tasks per call and per loop iteration)
+## Functions are decorated with @profile and loop iterations wrapped in `with section('test', variable=var, case=case):`;
+## both only check one flag while profiling is disabled (the default), so they can stay in the code.
+## Enable with enable() (or the environment variable CLIM_PROFILE=1, CLIM_PROFILE=memory to also trace allocations),
+## or for a block with `with profiling(trace='profile.json'):`
+## Records are nested (calls inside calls/sections) and can be exported as JSON, as a Chrome trace (chrome://tracing, Perfetto)
+## or summarised per function with summary()
+
+import os
+import sys
+import json
+import time
+import atexit
+import inspect
+import resource
+import threading
+import functools
+import tracemalloc
+import contextlib
+import numpy as np
+import pandas as pd
+
+_state = {'enabled': False, 'memory': False, 'origin': time.perf_counter(), 'tasks': 0}
+records = [] # one dict per finished call or section
+_local = threading.local() # stack of open calls/sections per thread
+_lock = threading.Lock()
+
+# ---- Sizes of the arguments and results ----
+
+# Bytes of arrays, pandas and xarray objects (logical size for dask-backed objects), also within tuples, lists and dicts
+def _nbytes(obj):
+    if isinstance(obj, (tuple, list)):
+        return sum(_nbytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(_nbytes(o) for o in obj.values())
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return int(obj.memory_usage(deep=False).sum()) if isinstance(obj, pd.DataFrame) else int(obj.memory_usage(deep=False))
+    nbytes = getattr(obj, 'nbytes', None) # numpy, dask and xarray (DataArray and Dataset)
+    return int(nbytes) if isinstance(nbytes, (int, np.integer)) else 0
+
+# Number of tasks in the dask graphs of lazy objects (0 for objects in memory)
+def _graph_size(obj):
+    if isinstance(obj, (tuple, list)):
+        return sum(_graph_size(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(_graph_size(o) for o in obj.values())
+    graph = obj.__dask_graph__() if hasattr(obj, '__dask_graph__') and not isinstance(obj, type) else None
+    return len(graph) if graph is not None else 0
+
+# ---- Dask tasks executed on local schedulers ----
+
+def _task_counter():
+    from dask.callbacks import Callback
+    class TaskCounter(Callback):
+        def _posttask(self, key, result, dsk, state, id):
+            _state['tasks'] += 1
+    return TaskCounter()
+
+# ---- Records ----
+
+def _max_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/2**20 if sys.platform == 'darwin' else rss/2**10 # MB (bytes on macOS, kB on Linux)
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def _start(name, labels):
+    stack = _stack()
+    record = {'name': name, 'labels': labels, 'depth': len(stack), 'parent': stack[-1]['name'] if stack else None,
+              'thread': threading.get_ident(), 'start': time.perf_counter() - _state['origin'],
+              '_wall': time.perf_counter(), '_cpu': time.process_time(), '_tasks': _state['tasks'], '_peak': 0}
+    if _state['memory'] and tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        if stack: # the peak so far belongs to the enclosing record
+            stack[-1]['_peak'] = max(stack[-1]['_peak'], peak)
+        tracemalloc.reset_peak()
+        record['_traced'] = current
+    stack.append(record)
+    return record
+
+def _finish(record):
+    stack = _stack()
+    stack.remove(record)
+    record['wall'] = time.perf_counter() - record.pop('_wall')
+    record['cpu'] = time.process_time() - record.pop('_cpu')
+    record['tasks_run'] = _state['tasks'] - record.pop('_tasks')
+    record['max_rss_MB'] = _max_rss()
+    peak = record.pop('_peak')
+    if '_traced' in record:
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        record['peak_alloc_MB'] = (peak - record.pop('_traced'))/2**20 # above the allocations at the start
+        if stack:
+            stack[-1]['_peak'] = max(stack[-1]['_peak'], peak)
+    with _lock:
+        records.append(record)
+
+# Decorator: time, CPU time, memory, input/output size and dask tasks of every call (while profiling is enabled)
+# labels: names of arguments recorded as labels, e.g. @profile(labels=['agg'])
+def profile(func=None, *, name=None, labels=()):
+    if func is None:
+        return lambda f: profile(f, name=name, labels=labels)
+    record_name = name or f'{func.__module__}.{func.__qualname__}'
+    signature = inspect.signature(func) if labels else None
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _state['enabled']:
+            return func(*args, **kwargs)
+        arguments = signature.bind_partial(*args, **kwargs).arguments if labels else {}
+        record = _start(record_name, {k: str(arguments[k]) for k in labels if k in arguments})
+        record['bytes_in'] = _nbytes(args) + _nbytes(kwargs)
+        record['graph_in'] = _graph_size(args) + _graph_size(kwargs)
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            record['error'] = type(e).__name__
+            raise
+        else:
+            record['bytes_out'] = _nbytes(result)
+            record['graph_out'] = _graph_size(result)
+            return result
+        finally:
+            _finish(record)
+    return wrapper
+
+# Context manager for a block or loop iteration, e.g. with section('seasonal_clim', variable=var, case=case):
+def section(name, **labels):
+    if not _state['enabled']:
+        return contextlib.nullcontext()
+    return _section(name, {k: str(v) for k, v in labels.items()})
+
+@contextlib.contextmanager
+def _section(name, labels):
+    record = _start(name, labels)
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        _finish(record)
+
+# ---- Switching on and off ----
+
+# Start recording; memory=True also traces Python allocations (tracemalloc, slower), tasks=True counts executed dask tasks
+def enable(memory=False, tasks=True):
+    _state.update(enabled=True, memory=memory)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _state['tracemalloc'] = True # started here, stopped in disable
+    if tasks and '_counter' not in _state:
+        try:
+            counter = _task_counter()
+        except ImportError: # without dask
+            return
+        counter.register()
+        _state['_counter'] = counter
+
+def disable():
+    _state.update(enabled=False, memory=False)
+    if _state.pop('tracemalloc', False):
+        tracemalloc.stop()
+    if '_counter' in _state:
+        _state.pop('_counter').unregister()
+
+def is_enabled():
+    return _state['enabled']
+
+# Remove all records
+def reset():
+    with _lock:
+        records.clear()
+    _state['origin'] = time.perf_counter()
+
+# Profile a block and optionally write the records, e.g. with profiling(trace='trace.json'): run()
+@contextlib.contextmanager
+def profiling(memory=False, tasks=True, output=None, trace=None):
+    enabled = _state['enabled']
+    if not enabled:
+        enable(memory=memory, tasks=tasks)
+    try:
+        yield records
+    finally:
+        if not enabled:
+            disable()
+        if output:
+            to_json(output)
+        if trace:
+            to_chrome_trace(trace)
+
+# ---- Export ----
+
+def _public(record):
+    return {k: v for k, v in record.items() if not k.startswith('_')}
+
+# All records as JSON (list of dicts with name, labels, start and wall/cpu time in s, sizes, tasks and memory in MB)
+def to_json(path):
+    with open(path, 'w') as f:
+        json.dump([_public(r) for r in records], f, indent=1)
+
+# Records in the Chrome trace event format (complete events in µs, one track per thread)
+def to_chrome_trace(path):
+    events = []
+    for r in records:
+        label = ' '.join(f'{v}' for v in r['labels'].values())
+        events.append({'name': f"{r['name']} {label}".strip(), 'cat': r['name'].split('.')[0], 'ph': 'X',
+                       'ts': r['start']*1e6, 'dur': r['wall']*1e6, 'pid': os.getpid(), 'tid': r['thread'],
+                       'args': {k: v for k, v in _public(r).items() if k not in ['name', 'start', 'wall', 'thread']}})
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+# Records as a DataFrame (one row per call or section, labels as columns)
+def to_frame():
+    rows = [{**{k: v for k, v in _public(r).items() if k != 'labels'}, **r['labels']} for r in records]
+    return pd.DataFrame(rows)
+
+# Totals per function/section (or per name and labels, e.g. by=['variable']), sorted by wall time
+def summary(by=None):
+    df = to_frame()
+    if df.empty:
+        return df
+    keys = ['name'] + list(by or [])
+    agg = {'calls': ('wall', 'size'), 'wall': ('wall', 'sum'), 'wall_max': ('wall', 'max'), 'cpu': ('cpu', 'sum'),
+           'tasks_run': ('tasks_run', 'sum'), 'max_rss_MB': ('max_rss_MB', 'max')}
+    for column, func in [('peak_alloc_MB', 'max'), ('bytes_in', 'max'), ('bytes_out', 'max'), ('graph_out', 'max')]:
+        if column in df:
+            agg[column] = (column, func)
+    out = df.groupby(keys, dropna=False).agg(**agg).sort_values('wall', ascending=False)
+    out['cpu_share'] = np.round(out['cpu']/out['wall'].where(out['wall'] > 0), 2) # < 1 when waiting (I/O), > 1 with threads
+    return out
+
+# Enabled from the environment, e.g. CLIM_PROFILE=1 CLIM_PROFILE_TRACE=trace.json python func_pipeline.py
+if os.environ.get('CLIM_PROFILE', '').lower() not in ['', '0', 'false']:
+    enable(memory=os.environ['CLIM_PROFILE'].lower() == 'memory')
+    if os.environ.get('CLIM_PROFILE_TRACE'):
+        atexit.register(lambda: to_chrome_trace(os.environ['CLIM_PROFILE_TRACE']))
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+## Batch rendering of figures in a process pool
+## A figure is declared as dict(func=..., kwargs={...}, inputs=[...], outputs=[...]):
+##   func(**kwargs) draws the figure and returns it (a module-level function, so that it can be sent to the worker processes),
+##   inputs are the data files it reads, outputs the files to save (e.g., ['Figures/climate/Fig4.png', 'Figures/climate/Fig4.pdf'])
+## Figures whose function, arguments and input files are unchanged since the last successful rendering are skipped,
+## so an interrupted run continues where it stopped
+
+import os
+import json
+import traceback
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from func_cache import cache_key
+
+vector_formats = ['.pdf', '.svg', '.eps', '.ps']
+
+# Projected map features, cached once per process
+def _map_features():
+    import func_plots
+    try:
+        func_plots.map_features()
+    except OSError: # Natural Earth data not available (yet); downloaded on first use
+        pass
+
+# Worker setup (worker processes only): non-interactive backend, paper style, and the map features
+def init_worker(style=True):
+    import matplotlib
+    matplotlib.use('Agg')
+    if style:
+        import plotting
+        plotting.set_plot_param()
+    _map_features()
+
+# Setup for rendering in the calling process (n_workers=1): the paper style applies only within the block,
+# and the backend of the session (e.g., a notebook) is left unchanged; figures are closed after saving
+@contextlib.contextmanager
+def in_process(style=True):
+    import matplotlib
+    with matplotlib.rc_context():
+        if style:
+            import plotting
+            plotting.set_plot_param()
+        _map_features()
+        yield
+
+# Draw one figure and save all outputs (dense layers rasterized in vector formats)
+def render_figure(spec):
+    import matplotlib.pyplot as plt
+    from func_plots import rasterize_dense
+    fig = spec['func'](**spec.get('kwargs', {}))
+    try:
+        for output in spec['outputs']:
+            if os.path.splitext(output)[1].lower() in vector_formats and spec.get('rasterize', True):
+                rasterize_dense(fig)
+            if os.path.dirname(output):
+                os.makedirs(os.path.dirname(output), exist_ok=True)
+            fig.savefig(output)
+    finally:
+        plt.close(fig)
+    return spec['outputs']
+
+def figure_key(spec):
+    return cache_key(spec['func'], (), spec.get('kwargs', {}), files=spec.get('inputs'))
+
+# Keys of the last successful runs (JSON {name: key}), shared with func_pipeline
+def load_state(state_file):
+    if os.path.isfile(state_file):
+        with open(state_file) as f:
+            return json.load(f)
+    return dict()
+
+def save_state(state, state_file):
+    if os.path.dirname(state_file):
+        os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(state_file + '.tmp', state_file)
+
+# Render the declared figures {name: spec}, in parallel processes (n_workers=1: in this process, e.g., for debugging)
+# Returns the status per figure: 'skipped' (up to date), 'rendered', or the error message
+def render_figures(figures, n_workers=None, force=False, state_file='Figures/.render_state.json', style=True):
+    state = load_state(state_file)
+    status = dict()
+    todo = dict()
+    for name, spec in figures.items():
+        key = figure_key(spec)
+        if not force and state.get(name) == key and all(os.path.isfile(output) for output in spec['outputs']):
+            status[name] = 'skipped'
+        else:
+            todo[name] = (spec, key)
+
+    def done(name, key, error=None):
+        if error is None:
+            state[name] = key
+            save_state(state, state_file) # after each figure, so that an interrupted run can be resumed
+            status[name] = 'rendered'
+        else:
+            state.pop(name, None)
+            save_state(state, state_file)
+            status[name] = error
+        print(f'{name}: {status[name]}')
+
+    if n_workers == 1:
+        with in_process(style):
+            for name, (spec, key) in todo.items():
+                try:
+                    render_figure(spec)
+                    done(name, key)
+                except Exception:
+                    done(name, key, traceback.format_exc())
+    elif todo:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(style,)) as pool:
+            futures = {pool.submit(render_figure, spec): (name, key) for name, (spec, key) in todo.items()}
+            for future in as_completed(futures):
+                name, key = futures[future]
+                try:
+                    future.result()
+                    done(name, key)
+                except Exception:
+                    done(name, key, traceback.format_exc())
+    return status
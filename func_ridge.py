@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+## Ridge regression of the temperature response on land cover transitions, with spatial block bootstrapping
+## (ridge_pipeline of 5_PFT-transitions_Ridge.ipynb as a library, with ridge_table as array-native version of prep_ridge_data)
+## The inputs of each region (polynomial features, target, weights, blocks) are prepared once and shared with the worker
+## processes (memory-mapped by joblib); runs of all regions are fitted in parallel with the same seeds as in the notebook
+## (seed = run), so the results do not depend on the number of workers. Per-cell contributions are summed as batches
+## of runs finish instead of keeping them for every run.
+## With solver='gram', each run is solved from statistics per spatial block (X'X, X'y, sums, counts) summed over its
+## training blocks, so a run costs O(features^3) for the fit instead of O(cells x features^2).
+
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+from joblib import Parallel, delayed
+from sklearn.preprocessing import StandardScaler, PolynomialFeatures
+from sklearn.linear_model import RidgeCV
+from sklearn.metrics import mean_absolute_error as MAE, r2_score
+from sklearn.model_selection import GroupShuffleSplit
+from func_calc import calc_transitions
+from func_ci import confidence_interval_percentiles
+
+regions = ['North','West','East','South', 'EU+']
+eu_region = 'EU+' # all cells
+alphas = np.logspace(-1, 3.3, 50)
+
+# Renaming of the variables for the feature table (as in prep_scenario)
+name_dict = {'T_2M': 'T2m', 'TSKIN': 'Tskin', 'ALBEDO': 'Albedo', 'z0m': 'Roughness',
+             'PCT_TREE_NL': 'TreeNL', 'PCT_TREE_BL': 'TreeBL', 'PCT_SHRUB': 'Shrub', 'PCT_GRASS': 'Grass', 'PCT_CROP': 'Crop',
+             'PCT_CROP_rain': 'CropR', 'PCT_CROP_irr': 'CropI', 'PCT_BARE': 'Bare'}
+types = ['TreeNL', 'TreeBL', 'Shrub', 'Grass', 'CropR', 'CropI', 'Bare'] # vegetation types of the transitions
+columns = ['T2m', 'Tskin', 'Albedo', 'Roughness', 'EF', 'Temp', 'Prec', 'pct_change'] # targets and other variables kept in the table
+
+# Define blocks for spatial block bootstrapping: blocks of blockdim x blockdim cells, numbered from 1 in the lower left corner
+def spatial_blocks(lats, lons, blockdim=5):
+    n_lon_blocks = -(-len(lons) // blockdim)
+    data = (np.arange(len(lats))[:, None] // blockdim) * n_lon_blocks + np.arange(len(lons))[None, :] // blockdim + 1
+    return xr.DataArray(data.astype(float), dims=["lat", "lon"], coords={"lat": np.asarray(lats), "lon": np.asarray(lons)})
+
+# Feature table for the ridge regression (array-native version of prep_scenario and prep_ridge_data)
+# dds: Dataset (lat, lon) with the renamed variables (differences to SSP1, Temp, Prec, pct_change) and the PFT changes of `types`
+# mask: cells to include (e.g., eunis==1), region: subregion index per cell (e.g., mask_2D), region_dict: {index: name}
+# Cells are selected by flat index of the mask and the available target, one variable at a time; the table has one row per cell
+# (plain RangeIndex, no MultiIndex), and EU+ rows are not duplicated (region_rows selects all cells for EU+)
+def ridge_table(dds, mask, region, region_dict, area, blockdim=None, target='T2m', columns=columns, types=types, aux=[]):
+    dds = dds.transpose('lat', 'lon', ...)
+    nlon = dds.sizes['lon']
+    cells = np.flatnonzero(np.asarray(mask.transpose('lat', 'lon'), dtype=bool).ravel() & np.isfinite(np.asarray(dds[target]).ravel()))
+    take = lambda da: np.asarray(da.transpose('lat', 'lon')).ravel()[cells]
+
+    table = {'lat': dds.lat.values[cells // nlon], 'lon': dds.lon.values[cells % nlon],
+             'region': pd.Series(take(region)).replace(region_dict).values} # unmapped indices are kept (as in the notebook)
+    if blockdim:
+        table['block'] = take(spatial_blocks(dds.lat, dds.lon, blockdim))
+    table['area'] = take(area)
+    table.update({var: take(dds[var]) for var in columns})
+    df = pd.DataFrame(table)
+
+    # Net transitions, without transitions that do not occur
+    trans = calc_transitions(pd.DataFrame({t: take(dds[t]) for t in types}), types)
+    trans = trans.loc[:, trans.sum() != 0]
+    df = df.join(trans)
+    if 'Latitude' in aux:
+        df[['Latitude','Longitude']] = df[['lat','lon']].values # rename to avoid same names as xarray coords
+    return df, list(trans.columns) + aux
+
+# Table with EU+ rows as a copy of all cells followed by the subregion rows (layout of prep_ridge_data, e.g., for the saved data)
+def with_eu_rows(data):
+    if (data.region == eu_region).any():
+        return data
+    return pd.concat([data.assign(region=eu_region), data.loc[data.region.notna()]])
+
+# Rows of one region; the EU+ rows may be stored once for all cells (ridge_table) instead of as a copy of all cells (prep_ridge_data)
+def region_rows(data, region):
+    if region == eu_region and not (data.region == eu_region).any():
+        return data
+    return data.loc[data.region == region]
+
+# Inputs of one region as arrays, prepared once for all runs
+# - aux features as anomaly in % of the area-weighted regional mean (as in the notebook)
+# - polynomial (interaction) features of all cells, for fitting and for the contributions
+# - cells used for fitting: target available and within 2 standard deviations (remove_outliers)
+def region_inputs(data, region, target, features, aux=[], interaction=1, remove_outliers=True):
+    df = region_rows(data, region)
+    X = df[features].copy()
+    if aux:
+        aux_mean = X[aux].mul(df.area, axis=0).sum(axis=0) / df.area.sum() # weighted spatial average
+        X[aux] = 100 * (X[aux] - aux_mean) / aux_mean
+    poly = PolynomialFeatures(degree=interaction, interaction_only=True, include_bias=False) # intercept generated by the regression
+    Xp = poly.fit_transform(X.values.astype(float))
+
+    y = df[target]
+    fit = y.notna().values.copy()
+    if remove_outliers:
+        zscore = (y - y[fit].mean()) / y[fit].std()
+        fit &= ~(np.abs(zscore.values) > 2)
+    fit = np.flatnonzero(fit)
+    return {'region': region,
+            'names': list(poly.get_feature_names_out(input_features=features)),
+            'X': Xp, 'y': y.values.astype(float), 'area': df.area.values.astype(float),
+            'fit': fit, 'groups': df.block.values[fit],
+            'dT': np.nansum(y.values*df.area.values) / np.nansum(df.area.values), # actual dT, weighted spatial average
+            'index': df.index, 'cells': df[['lat','lon','region','area',target]].assign(region=region)}
+
+# Train/test cells of one run: test_size refers to spatial blocks, not to cells
+def block_split(inputs, seed, test_size=0.25):
+    gss = GroupShuffleSplit(n_splits=1, test_size=test_size, random_state=seed)
+    train, test = next(gss.split(inputs['fit'], groups=inputs['groups']))
+    return inputs['fit'][train], inputs['fit'][test]
+
+# Sufficient statistics per spatial block of the fitting cells: count, sums, X'X, X'y and y'y
+# (computed on values shifted by the regional mean, for accuracy of the centred Gram matrices)
+def block_statistics(inputs):
+    X, y = inputs['X'][inputs['fit']], inputs['y'][inputs['fit']]
+    shift_x, shift_y = X.mean(axis=0), y.mean()
+    X, y = X - shift_x, y - shift_y
+    blocks, cell_block = np.unique(inputs['groups'], return_inverse=True)
+    order = np.argsort(cell_block, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(cell_block[order]) != 0])
+    X, y = X[order], y[order]
+    return {'blocks': blocks, 'cell_block': cell_block, 'shift_x': shift_x, 'shift_y': shift_y,
+            'n': np.bincount(cell_block).astype(float),
+            'sx': np.add.reduceat(X, starts, axis=0), 'sy': np.add.reduceat(y, starts),
+            'xx': np.stack([Xb.T @ Xb for Xb in np.split(X, starts[1:])]),
+            'xy': np.add.reduceat(X * y[:, None], starts, axis=0), 'yy': np.add.reduceat(y**2, starts)}
+
+def _sum_blocks(stats, mask):
+    return {k: stats[k][mask].sum(axis=0) for k in ['n', 'sx', 'sy', 'xx', 'xy', 'yy']}
+
+# Ridge path on standardised features from summed statistics: coefficients (features x alphas) and intercepts (alphas),
+# in the shifted, non-standardised space; the eigendecomposition of the standardised Gram matrix solves all alphas at once
+def _ridge_path(s, alphas):
+    mean_x, mean_y = s['sx']/s['n'], s['sy']/s['n']
+    gram = s['xx'] - s['n']*np.outer(mean_x, mean_x)
+    scale = np.sqrt(np.clip(np.diag(gram), 0, None)/s['n'])
+    scale[scale == 0] = 1 # constant features, as in StandardScaler
+    eigval, eigvec = np.linalg.eigh(gram/np.outer(scale, scale))
+    proj = eigvec.T @ ((s['xy'] - s['n']*mean_x*mean_y)/scale)
+    coef = (eigvec @ (proj[:, None]/(np.clip(eigval, 0, None)[:, None] + alphas[None, :])))/scale[:, None]
+    return coef, mean_y - mean_x @ coef
+
+# Sum of squared errors of intercept + X coef on summed statistics
+def _sse(s, coef, intercept):
+    return (s['yy'] - 2*intercept*s['sy'] - 2*s['xy'] @ coef + s['n']*intercept**2 + 2*intercept*(s['sx'] @ coef)
+            + np.einsum('ia,ij,ja->a', coef, s['xx'], coef))
+
+# Fit of one run from the block statistics (solver='gram')
+# alpha is selected by cv_folds-fold cross-validation over the training blocks (seeded by the run), also from block statistics
+def _fit_gram(stats, train_blocks, seed, alphas, cv_folds=5):
+    folds = np.full(len(train_blocks), -1)
+    folds[train_blocks] = np.random.default_rng(seed).permutation(train_blocks.sum()) % cv_folds
+    total = _sum_blocks(stats, train_blocks)
+    sse = 0
+    for k in range(cv_folds):
+        held_out = _sum_blocks(stats, folds == k)
+        rest = {key: total[key] - held_out[key] for key in total}
+        sse = sse + _sse(held_out, *_ridge_path(rest, alphas))
+    best = np.argmin(sse)
+    coef, intercept = _ridge_path(total, alphas[[best]])
+    return alphas[best], coef[:, 0], intercept[0] + stats['shift_y'] - stats['shift_x'] @ coef[:, 0]
+
+# Fit of one run with StandardScaler and RidgeCV (solver='sklearn', as in the notebook: alpha by efficient leave-one-out)
+def _fit_sklearn(X, y, train, alphas):
+    scaler = StandardScaler().fit(X[train])
+    ridge = RidgeCV(alphas=alphas, fit_intercept=True).fit(scaler.transform(X[train]), y[train])
+    coef = ridge.coef_/scaler.scale_ # non-standardised coefficients (sensitivity, per unit (%) change)
+    intercept = ridge.intercept_ - np.sum(ridge.coef_*(scaler.mean_/scaler.scale_)) # when original features are zero
+    return ridge.alpha_, coef, intercept, lambda cells: ridge.predict(scaler.transform(X[cells]))
+
+# Fit a batch of runs of one region; returns the results per run and the per-cell contributions summed over the runs
+def _fit_runs(inputs, runs, test_size=0.25, alphas=alphas, solver='sklearn', cv_folds=5):
+    X, y, area = inputs['X'], inputs['y'], inputs['area']
+    x_mean = np.nansum(X * area[:, None], axis=0) / np.nansum(area) # weighted spatial average of the features
+    results = []
+    coef_sum = np.zeros(X.shape[1])
+    for run in runs:
+        train, test = block_split(inputs, seed=run, test_size=test_size)
+        if solver == 'gram':
+            stats = inputs['stats']
+            train_blocks = np.zeros(len(stats['blocks']), dtype=bool)
+            train_blocks[stats['cell_block'][np.searchsorted(inputs['fit'], train)]] = True
+            alpha, coef, intercept = _fit_gram(stats, train_blocks, run, alphas, cv_folds)
+            predict = lambda cells: intercept + X[cells] @ coef
+        else:
+            alpha, coef, intercept, predict = _fit_sklearn(X, y, train, alphas)
+        pred_train, pred_test = predict(train), predict(test)
+
+        coef_sum += coef
+        results.append({'run': run,
+                        'performance': {'alpha': alpha,
+                                        'MAE_train': round(MAE(y[train], pred_train), 3),
+                                        'MAE_test': round(MAE(y[test], pred_test), 3),
+                                        'R2_train': round(r2_score(y[train], pred_train), 3),
+                                        'R2_test': round(r2_score(y[test], pred_test), 3)},
+                        'coef': coef,
+                        'intercept': intercept,
+                        'contrib': coef * x_mean, # feature contributions, weighted spatial average
+                        'prediction': intercept + coef @ x_mean}) # predicted dT, weighted spatial average
+    return inputs['region'], results, X * coef_sum # feature contributions per grid cell, summed over the runs
+
+# Spatial block bootstrap of the ridge regression for all regions
+# data: cells x (target, features, region, block, area, lat, lon), as from prep_ridge_data
+# Runs are fitted in batches of batch_size in n_jobs processes (n_jobs=1: in this process)
+# solver: 'sklearn' (StandardScaler and RidgeCV per run, as in the notebook) or 'gram' (closed-form ridge path from statistics
+# per spatial block, summed over the blocks of each split; cost per run independent of the number of cells except for
+# the performance scores, alpha selected by cv_folds-fold cross-validation over the training blocks)
+# Returns a dict of DataFrames: result (per run), coef and contrib (per run), their means and percentile CIs per region,
+# contrib_cells (per cell and feature) and contrib_sum (per cell), both averaged over the runs
+def ridge_bootstrap(data, target, features, regions=regions, aux=[], runs=100, test_size=0.25, interaction=1, alphas=alphas,
+                    solver='sklearn', cv_folds=5, n_jobs=-1, batch_size=10, verbose=0):
+    inputs = {reg: region_inputs(data, reg, target, features, aux=aux, interaction=interaction) for reg in regions}
+    if solver == 'gram':
+        for reg in regions:
+            inputs[reg]['stats'] = block_statistics(inputs[reg])
+    tasks = [(reg, list(range(start, min(start + batch_size, runs)))) for reg in regions for start in range(0, runs, batch_size)]
+    parallel = Parallel(n_jobs=n_jobs, max_nbytes='1M', mmap_mode='r', return_as='generator', verbose=verbose)
+
+    # Aggregated as the batches finish (in order of submission, so sums do not depend on n_jobs)
+    results = {reg: [] for reg in regions}
+    contrib_sums = {reg: 0. for reg in regions}
+    for reg, batch, contrib_sum in parallel(delayed(_fit_runs)(inputs[reg], batch, test_size, alphas, solver, cv_folds)
+                                            for reg, batch in tasks):
+        results[reg] += batch
+        contrib_sums[reg] = contrib_sums[reg] + contrib_sum
+    return _collect(data, target, inputs, results, contrib_sums, runs)
+
+def _collect(data, target, inputs, results, contrib_sums, runs):
+    regions = list(inputs)
+    names = inputs[regions[0]]['names']
+    reglabel = np.repeat(regions, runs)
+    rows = [r for reg in regions for r in sorted(results[reg], key=lambda r: r['run'])]
+
+    # Sensitivity (non-standardised coefficient) and feature contribution (coef*delta)
+    df_coef = pd.DataFrame(np.vstack([r['coef'] for r in rows]), columns=names)
+    df_coef.insert(0, column='region', value=reglabel)
+    df_contrib = pd.DataFrame(np.vstack([r['contrib'] for r in rows]), columns=names)
+    df_contrib.insert(0, column='region', value=reglabel)
+
+    # Results per fit
+    df_result = pd.DataFrame([r['performance'] for r in rows])
+    df_result.insert(0, column='region', value=reglabel)
+    df_result['intercept'] = [r['intercept'] for r in rows]
+    df_result['contrib'] = df_contrib[names].sum(axis=1)
+    df_result['prediction'] = [r['prediction'] for r in rows] # predicted dT, weighted spatial average
+    df_result['dT'] = df_result.region.map({reg: inputs[reg]['dT'] for reg in regions}) # actual dT
+    df_result['bias'] = df_result.prediction - df_result.dT
+    df_result['frac_contrib'] = (100*(df_result.contrib/df_result.prediction)).round(1)
+    df_result['frac_bias'] = (100*(df_result.bias/df_result.prediction)).round(1)
+
+    # Contributions per grid cell, mean over the runs
+    contrib_cells, contrib_sum = [], []
+    for reg in regions:
+        cells = inputs[reg]['cells']
+        mean = pd.DataFrame(contrib_sums[reg]/runs, index=inputs[reg]['index'], columns=names)
+        summed = mean.sum(axis=1).rename('contrib').to_frame()
+        summed['intercept'] = np.mean([r['intercept'] for r in results[reg]])
+        contrib_sum.append(summed.join(cells))
+        contrib_cells.append(mean.join(cells[['lat','lon','region']]))
+
+    return {'result': df_result,
+            'coef': df_coef, 'coef_mean': df_coef.groupby('region').mean(),
+            'coef_ci': confidence_interval_percentiles(df_coef, group_dim='region', confidence=0.95),
+            'contrib': df_contrib, 'contrib_mean': df_contrib.groupby('region').mean(),
+            'contrib_ci': confidence_interval_percentiles(df_contrib, group_dim='region', confidence=0.95),
+            'contrib_cells': pd.concat(contrib_cells), 'contrib_sum': pd.concat(contrib_sum)}
+
+# Save the outputs for target and case as in the notebook ({model}_{target}_{case}_result.csv etc.)
+def save_outputs(outputs, data, path, model, target, case):
+    os.makedirs(path, exist_ok=True)
+    prefix = path + f'{model}_{target}_{case}'
+    with_eu_rows(data).to_csv(prefix + '_data.csv')
+    outputs['result'].to_csv(prefix + '_result.csv')
+    for name in ['coef_mean', 'coef_ci', 'contrib_mean', 'contrib_ci']:
+        outputs[name].to_csv(prefix + '_' + name.replace('_', '') + '.csv')
+
+# Run multi-region ridge with spatial block bootstrap and save the outputs (replaces ridge_pipeline of the notebook)
+def ridge_pipeline(case, target, data, features, model, runs, test_size, interaction, path, aux=[], solver='sklearn', n_jobs=-1):
+    outputs = ridge_bootstrap(data, target, features, aux=aux, runs=runs, test_size=test_size, interaction=interaction, solver=solver, n_jobs=n_jobs)
+    save_outputs(outputs, data, path, model, target, case)
+    return outputs
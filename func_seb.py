@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+## Functions for the linearised surface energy balance (SEB) decomposition of ΔTskin (4_T-decomposition.ipynb)
+## The contributions are computed per grid cell (and season/year) in one vectorised pass; dask-backed inputs stay lazy
+## Regional means and confidence intervals are derived afterwards from the per-cell contributions
+
+import xarray as xr
+import func_ci
+
+# Constants
+sigma = 5.67e-8 # Stefan Boltzman constant (Wm² K^-4)
+Es = 1          # surface emissivity is assumed constant = 1
+
+# Variables
+in_vars = ['TBOT', 'TSKIN', 'T_2M', 'SWdown', 'SWup', 'LWdown', 'LWup', 'LH', 'SH']
+seb_vars = ['Ta', 'T2m', 'Tskin', 'SWdown', 'SWup', 'LWdown', 'LWup', 'LH', 'SH', 'R', 'Albedo', 'Ea']
+aux_vars = ['z0m', 'EF', 'TLAI', 'QIRRIG']
+
+# Output of decompose (temperature changes, contributions, sums and residual; all in K)
+components = ['ΔTa', 'ΔT2m', 'ΔTskin', 'LH', 'SH', 'G', 'Albedo', 'SWdown', 'LWdown', 'Sum', 'Sum surface', 'Sum atmos', 'Residual']
+contributions = ['LH', 'SH', 'G', 'Albedo', 'SWdown', 'LWdown']
+
+# Variables used by decompose from the reference and the difference
+ref_vars = ['Tskin', 'SWdown', 'Albedo']
+diff_vars = ['Ta', 'T2m', 'Tskin', 'LH', 'SH', 'R', 'Albedo', 'SWdown', 'LWdown']
+
+# Convert temperatures to K and add the SEB residual, surface albedo and atmospheric emissivity
+def process_seb(ds):
+    T_vars = ['TBOT', 'TSA', 'TSKIN', 'T_2M', 'T_G'] # in °C
+    with xr.set_options(keep_attrs=True): # to preserve the units
+        for T_var in T_vars:
+            if T_var in list(ds.keys()):
+                ds[T_var] = (ds[T_var]+273.15).assign_attrs(units='K')  # convert to K
+    ds = ds.rename({'TBOT': 'Ta', 'T_2M': 'T2m', 'TSKIN': 'Tskin'})
+    ds['R'] = ds.SWdown - ds.SWup + ds.LWdown - ds.LWup - ds.SH - ds.LH # SEB residual (primarily ground heat flux and storage, including snow melt)
+    ds['Albedo'] = ds.SWup/ds.SWdown                                    # Surface albedo
+    ds['Ea'] = ds.LWdown/(sigma*ds.Ta**4)                               # Optional: atmospheric emissivity (to split LWdown into Ea and Ta)
+    return ds
+
+# Contributions for plain arrays (reference Tskin, SWdown and Albedo, then the differences in the order of diff_vars)
+def _seb_kernel(Tskin, SWdown, Albedo, dTa, dT2m, dTskin, dLH, dSH, dR, dAlbedo, dSWdown, dLWdown):
+    term = 1/(4*Es*sigma*Tskin**3) # surface temperature sensitivity to 1 Wm-2
+    LH = term * -dLH
+    SH = term * -dSH
+    G = term * -dR
+    albedo = term * -SWdown * dAlbedo
+    swdown = term * (1 - Albedo) * dSWdown
+    lwdown = term * dLWdown # can be used instead of Ea and Ta
+    surface = LH + SH + G + albedo
+    atmos = swdown + lwdown
+    total = surface + atmos
+    return dTa, dT2m, dTskin, LH, SH, G, albedo, swdown, lwdown, total, surface, atmos, dTskin - total
+
+# Linearised decomposition of ΔTskin for every element of ref (processed SSP1) and diff (processed case minus SSP1)
+# Works on any dims (lat/lon, season, year, region, ...); dask-backed inputs give one task per chunk
+def decompose(ref, diff):
+    ref, diff = xr.align(ref[ref_vars], diff[diff_vars], join='inner')
+    out = xr.apply_ufunc(
+        _seb_kernel,
+        *[ref[v] for v in ref_vars], *[diff[v] for v in diff_vars],
+        output_core_dims=[[]]*len(components),
+        dask='parallelized',
+        output_dtypes=[float]*len(components),
+    )
+    return xr.Dataset(dict(zip(components, out))).assign_attrs(units='K')
+
+# Decomposition of a case against SSP1 from the unprocessed model output (as proc_case_mapping in the notebook)
+def decompose_case(ds_ssp1, ds_case):
+    ds_ssp1 = process_seb(ds_ssp1)[seb_vars]
+    ds_case = process_seb(ds_case)[seb_vars]
+    return decompose(ds_ssp1, ds_case - ds_ssp1)
+
+# Regional means of the per-cell contributions: weighted per region (func_calc.RegionAggregator)
+# and, optionally, unweighted over boolean masks with a region dim (e.g., the Min/Max masks of func_calc.extreme_area)
+def regional_decomposition(data, aggregator, masks=None, dim=['lat','lon']):
+    means = aggregator.mean(data)
+    if masks is None:
+        return means
+    valid = masks & data.notnull()
+    extremes = data.where(valid, 0).sum(dim)/valid.sum(dim)
+    means = means.drop_vars([c for c in means.coords if c != 'region' and 'region' in means[c].dims]) # region labels only
+    return xr.concat([means, extremes], dim='region')
+
+# Mean and t-based confidence interval (half width) over dim, e.g. the years of the regional means
+def mean_ci(ds, dim='year', confidence=0.95):
+    return func_ci.mean_ci(ds, dim=dim, confidence=confidence)
@@ -4,11 +4,13 @@
 ## Petra Sieber, Dec 2025
 
 from scipy import stats
+import scipy.special
+import scipy.ndimage
+import functools
 import numpy as np
 import xarray as xr
-import statsmodels as sm
-from statsmodels.stats.multitest import multipletests
 import itertools
+from func_profile import profile, section
 
 # Significance testing on gridded data (xarray)
 # Student t-test: parametric test for independent/dependent samples, data is normally distributed 
@@ -47,17 +49,10 @@ def ttest_2samp(da1, da2, paired=False, dim="time", global_alpha=0.05):
         output_dtypes=[float],
     ).compute()
 
-    # apply Benjamini and Hochberg correction
-    shape = result.shape
-    
-    values = result.values.ravel()
-    notnull = np.isfinite(values)
-
-    p_adjust = multipletests(
-        values[notnull], alpha=global_alpha, method="fdr_bh"
-    )[0]
-    values[notnull] = p_adjust
-    result.values = values.reshape(shape)
+    # apply Benjamini and Hochberg correction (1 where rejected, NaNs preserved)
+    values = result.values
+    reject = fdr_bh(values, alpha=global_alpha)[0]
+    result.values = np.where(np.isfinite(values), reject, values)
 
     return result
 
@@ -96,17 +91,10 @@ def mannwhitney(da1, da2, paired=False, dim="time", global_alpha=0.05):
         output_dtypes=[float],
     ).compute()
 
-    # apply Benjamini and Hochberg correction
-    shape = result.shape
-    
-    values = result.values.ravel()
-    notnull = np.isfinite(values)
-
-    p_adjust = multipletests(
-        values[notnull], alpha=global_alpha, method="fdr_bh"
-    )[0]
-    values[notnull] = p_adjust
-    result.values = values.reshape(shape)
+    # apply Benjamini and Hochberg correction (1 where rejected, NaNs preserved)
+    values = result.values
+    reject = fdr_bh(values, alpha=global_alpha)[0]
+    result.values = np.where(np.isfinite(values), reject, values)
 
     return result
 
@@ -121,42 +109,214 @@ def mannwhitney(da1, da2, paired=False, dim="time", global_alpha=0.05):
 # Wilcoxon rank-sum test: non-parametric test for dependent samples (two-sided)
 # Mann-Whitney U rank test: non-parametric test for independent samples (two-sided)
 
+# Reference path: one scipy call per cell
+def _wilcoxon_scipy(x):
+    x = x[~np.isnan(x)]
+    if x.size < 2:
+        return np.nan, np.nan, np.nan
+
+    res = stats.wilcoxon(x)
+    W, p = res.statistic, res.pvalue
+
+    n = x.size
+    # Wilcoxon expected value and SD under H0
+    mean_W = n * (n + 1) / 4
+    sd_W   = np.sqrt(n * (n + 1) * (2*n + 1) / 24)
+
+    z = (W - mean_W) / sd_W
+    r = z / np.sqrt(n)
+    return W, p, r
+
+def _mannwhitneyu_scipy(x, y):
+    x = x[~np.isnan(x)]
+    y = y[~np.isnan(y)]
+    if x.size == 0 or y.size == 0:
+        return np.nan, np.nan, np.nan
+
+    res = stats.mannwhitneyu(x, y)
+    U, p = res.statistic, res.pvalue
+
+    n1, n2 = x.size, y.size
+    r = 1 - (2 * U) / (n1 * n2)
+    return U, p, r
+
+
+# -------------------------------------------------------------------
+# Batched engine: ranks whole (cells, n) blocks at once
+# Follows the scipy defaults (method="auto") so that results are identical to the reference path:
+#   - Wilcoxon: exact null distribution for n <= 50 without ties/zeros, normal approximation otherwise
+#   - Mann-Whitney U: normal approximation with tie and continuity correction
+# The few cells that scipy would send to a permutation test (Wilcoxon, n <= 13 with ties/zeros) or to the
+# exact MWU distribution (n1 or n2 <= 8 without ties) are passed to the reference path.
+# -------------------------------------------------------------------
+
+# Average ranks along the last axis of a 2D block; NaNs are ranked last and never tied (as in scipy)
+def _rank_ties(a):
+    m, n = a.shape
+    order = np.argsort(a, axis=-1, kind="stable")
+    y = np.take_along_axis(a, order, axis=-1)
+    pos = np.broadcast_to(np.arange(n), (m, n))
+
+    start = np.ones((m, n), dtype=bool)
+    start[:, 1:] = y[:, 1:] != y[:, :-1]
+    stop = np.ones((m, n), dtype=bool)
+    stop[:, :-1] = start[:, 1:]
+    first = np.maximum.accumulate(np.where(start, pos, 0), axis=-1)
+    last = np.minimum.accumulate(np.where(stop, pos, n - 1)[:, ::-1], axis=-1)[:, ::-1]
+    counts = last - first + 1
+
+    ranks = np.empty((m, n), dtype=np.float64)
+    np.put_along_axis(ranks, order, first + 1 + (counts - 1) / 2, axis=-1)
+    tie_term = np.where(start, counts**3 - counts, 0).sum(axis=-1)
+    has_ties = (counts > 1).any(axis=-1)
+    return ranks, tie_term, has_ties
+
+# Exact null distribution of the Wilcoxon statistic r_plus (same recursion as scipy)
+@functools.lru_cache(maxsize=None)
+def _wilcoxon_exact_table(n):
+    c = np.ones(1, dtype=np.float64)
+    for k in range(1, n + 1):
+        prev_c = c
+        c = np.zeros(k * (k + 1) // 2 + 1, dtype=np.float64)
+        m = len(prev_c)
+        c[:m] = prev_c * 0.5
+        c[-m:] += prev_c * 0.5
+    # Tabulate sf(k) and cdf(k) for all k, summing from the nearer tail like scipy
+    mn = n * (n + 1) / 4
+    k = np.arange(c.size)
+    sf = np.array([c[i:].sum() if i <= mn else 1 - c[:i].sum() for i in k])
+    cdf = np.array([c[:i + 1].sum() if i <= mn else 1 - c[i + 1:].sum() for i in k])
+    return sf, cdf
+
+def _float_dtype(*arrays):
+    dtype = np.result_type(*arrays)
+    return dtype if np.issubdtype(dtype, np.floating) else np.dtype(np.float64)
+
+# Compress the rows of a (cells, time) block into groups with equal numbers of valid values
+def _iter_valid_counts(*blocks):
+    valid = [~np.isnan(b) for b in blocks]
+    counts = np.stack([v.sum(axis=-1) for v in valid], axis=-1)
+    for key in np.unique(counts, axis=0):
+        rows = np.flatnonzero((counts == key).all(axis=-1))
+        dense = [b[rows][v[rows]].reshape(rows.size, int(k)) for b, v, k in zip(blocks, valid, key)]
+        yield tuple(int(k) for k in key), rows, dense
+
+def _wilcoxon_batched(x):
+    dtype = _float_dtype(x)
+    shape = x.shape[:-1]
+    x = np.asarray(x, dtype=dtype).reshape(-1, x.shape[-1])
+    W, p, r = (np.full(x.shape[0], np.nan) for _ in range(3))
+
+    for (n,), rows, (d,) in _iter_valid_counts(x):
+        if n < 2:
+            continue
+
+        # Zeros are dropped (zero_method="wilcox")
+        zeros = d == 0
+        n_zero = zeros.sum(axis=-1)
+        ranks, tie_term, has_ties = _rank_ties(np.abs(np.where(zeros, np.nan, d)))
+        ranks, tie_term = ranks.astype(dtype), tie_term.astype(dtype)
+        r_plus = ((d > 0).astype(dtype) * ranks).sum(axis=-1)
+        r_minus = ((d < 0).astype(dtype) * ranks).sum(axis=-1)
+        W_n = np.minimum(r_plus, r_minus)
+        p_n = np.full(rows.size, np.nan, dtype=dtype)
+
+        # Choose the method per cell as scipy does
+        exact = ~(has_ties | (n_zero > 0)) & (n <= 50)
+        asymptotic = ~exact & (n > 13)
+        permutation = ~(exact | asymptotic)
+
+        if exact.any():
+            sf, cdf = _wilcoxon_exact_table(n)
+            k = r_plus[exact].astype(int)
+            p_n[exact] = np.clip(2 * np.minimum(sf[k], cdf[k]), 0, 1)
+
+        if asymptotic.any():
+            count = (n - n_zero[asymptotic]).astype(dtype)
+            mn = count * (count + 1.) * 0.25
+            se = count * (count + 1.) * (2. * count + 1.)
+            se = np.sqrt((se - tie_term[asymptotic]/2) / 24)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                z = (r_plus[asymptotic] - mn) / se
+            p_n[asymptotic] = 2 * scipy.special.ndtr(-np.abs(z))
+
+        # Same effect size as the reference path
+        mean_W = n * (n + 1) / 4
+        sd_W   = np.sqrt(n * (n + 1) * (2*n + 1) / 24)
+        z = (W_n - mean_W) / sd_W
+
+        W[rows], p[rows], r[rows] = W_n, p_n, z / np.sqrt(n)
+
+        for i in np.flatnonzero(permutation):
+            W[rows[i]], p[rows[i]], r[rows[i]] = _wilcoxon_scipy(d[i])
+
+    return W.reshape(shape), p.reshape(shape), r.reshape(shape)
+
+def _mannwhitneyu_batched(x, y):
+    dtype = _float_dtype(x, y)
+    shape = np.broadcast_shapes(x.shape[:-1], y.shape[:-1])
+    x = np.broadcast_to(np.asarray(x, dtype=dtype), shape + x.shape[-1:]).reshape(-1, x.shape[-1])
+    y = np.broadcast_to(np.asarray(y, dtype=dtype), shape + y.shape[-1:]).reshape(-1, y.shape[-1])
+    U, p, r = (np.full(x.shape[0], np.nan) for _ in range(3))
+
+    for (n1, n2), rows, (x_n, y_n) in _iter_valid_counts(x, y):
+        if n1 == 0 or n2 == 0:
+            continue
+
+        ranks, tie_term, has_ties = _rank_ties(np.concatenate([x_n, y_n], axis=-1))
+        ranks, tie_term = ranks.astype(dtype), tie_term.astype(dtype)
+        R1 = ranks[:, :n1].sum(axis=-1)
+        U1 = R1 - n1*(n1+1)/2
+        U2 = n1 * n2 - U1
+
+        # Normal approximation with tie correction and continuity correction
+        n = n1 + n2
+        s = np.sqrt(n1*n2/12 * ((n + 1) - tie_term/(n*(n-1))))
+        numerator = np.maximum(U1, U2) - n1 * n2 / 2
+        numerator -= 0.5
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = numerator / s
+        p_n = scipy.special.ndtr(-z)
+        p_n *= 2
+        p_n = np.clip(p_n, 0., 1.)
+
+        U[rows], p[rows], r[rows] = U1, p_n, 1 - (2 * U1) / (n1 * n2)
+
+        if n1 <= 8 or n2 <= 8:
+            for i in np.flatnonzero(~has_ties):
+                U[rows[i]], p[rows[i]], r[rows[i]] = _mannwhitneyu_scipy(x_n[i], y_n[i])
+
+    return U.reshape(shape), p.reshape(shape), r.reshape(shape)
+
+
 # -------------------------------------------------------------------
 # Test functions (reduce only along "dim")
 # -------------------------------------------------------------------
 
-def xr_wilcoxon(da, dim="time"):
+@profile(labels=["method"])
+def xr_wilcoxon(da, dim="time", method="batched"):
     """
     Vectorized Wilcoxon signed-rank test across "dim".
     Returns test statistic, p-value, and effect size.
     Effect size: point‑biserial‑like/Pearson‑r‑like correlation r = Z / sqrt(n).
+    method : "batched" (rank whole blocks of cells at once) or "scipy" (one scipy call per cell); results are identical.
     """
 
     dim = [dim] if isinstance(dim, str) else dim
 
-    def _wilcoxon(x):
-        x = x[~np.isnan(x)]
-        if x.size < 2:
-            return np.nan, np.nan, np.nan
-        
-        res = stats.wilcoxon(x)
-        W, p = res.statistic, res.pvalue
-
-        n = x.size
-        # Wilcoxon expected value and SD under H0
-        mean_W = n * (n + 1) / 4
-        sd_W   = np.sqrt(n * (n + 1) * (2*n + 1) / 24)
-
-        z = (W - mean_W) / sd_W
-        r = z / np.sqrt(n)
-        return W, p, r
+    if method == "batched":
+        func, vectorize = _wilcoxon_batched, False
+    elif method == "scipy":
+        func, vectorize = _wilcoxon_scipy, True
+    else:
+        raise ValueError(f"Unknown method '{method}'. Use 'batched' or 'scipy'.")
 
     W, p, r = xr.apply_ufunc(
-        _wilcoxon,
+        func,
         da,
         input_core_dims=[dim],
         output_core_dims=[[], [], []],
-        vectorize=True,
+        vectorize=vectorize,
         dask="parallelized",
         output_dtypes=[float, float, float],
     )
@@ -164,65 +324,292 @@ def xr_wilcoxon(da, dim="time"):
     return xr.Dataset({"statistic": W, "p": p, "effect_size": r})
 
 
-def xr_mannwhitneyu(da1, da2, dim="time"):
+@profile(labels=["method"])
+def xr_mannwhitneyu(da1, da2, dim="time", method="batched"):
     """
     Vectorized Mann–Whitney U test across "dim".
     Returns test statistic, p-value, and effect size.
     Effect size: rank-biserial correlation r = 1 - 2U/(n1*n2).
+    method : "batched" (rank whole blocks of cells at once) or "scipy" (one scipy call per cell); results are identical.
     """
 
     dim = [dim] if isinstance(dim, str) else dim
 
-    def _mw(x, y):
-        x = x[~np.isnan(x)]
-        y = y[~np.isnan(y)]
-        if x.size == 0 or y.size == 0:
-            return np.nan, np.nan, np.nan
-
-        res = stats.mannwhitneyu(x, y)
-        U, p = res.statistic, res.pvalue
-        
-        n1, n2 = x.size, y.size
-        r = 1 - (2 * U) / (n1 * n2)
-        return U, p, r
+    if method == "batched":
+        func, vectorize = _mannwhitneyu_batched, False
+    elif method == "scipy":
+        func, vectorize = _mannwhitneyu_scipy, True
+    else:
+        raise ValueError(f"Unknown method '{method}'. Use 'batched' or 'scipy'.")
 
     U, p, r = xr.apply_ufunc(
-        _mw,
+        func,
         da1, da2,
         input_core_dims=[dim, dim],
         output_core_dims=[[], [], []],
-        vectorize=True,
+        vectorize=vectorize,
         dask="parallelized",
         output_dtypes=[float, float, float],
     )
 
     return xr.Dataset({"statistic": U, "p": p, "effect_size": r})
 
+# -------------------------------------------------------------------
+# Permutation engine: sign flips (paired samples) or permutations of the sample labels (independent samples)
+# The permutations depend only on the sample sizes and are cached, so all variables, cases and seasons with
+# the same n (e.g., 15 years) use the same null designs. The statistic of a whole batch of permutations is
+# computed for all cells with one matrix product; only the per-cell exceedance counts, the field maxima and
+# the cluster masses of each permutation are kept.
+# Field tests (Wilks 2016 field significance, controlling the family-wise error rate over the field):
+#   - "max": maximum |t| over the field per permutation (Westfall-Young single step)
+#   - "cluster": maximum cluster mass (sum of |t| over connected cells with |t| above the threshold) per permutation
+# -------------------------------------------------------------------
+
+# Sign flips for n paired samples (n_perm x n); all 2^n patterns if that is not more than n_perm (exact test)
+@functools.lru_cache(maxsize=None)
+def _sign_flips(n, n_perm, seed):
+    if 2**n <= n_perm:
+        signs = 1. - 2. * ((np.arange(2**n)[:, None] >> np.arange(n)) & 1)
+        exact = True
+    else:
+        signs = np.random.default_rng(seed).choice([-1., 1.], size=(n_perm, n))
+        exact = False
+    signs.setflags(write=False)
+    return signs, exact
+
+# Membership of the first sample for random permutations of n1 + n2 labels (n_perm x (n1 + n2), 0/1)
+@functools.lru_cache(maxsize=None)
+def _label_permutations(n1, n2, n_perm, seed):
+    order = np.argsort(np.random.default_rng(seed).random((n_perm, n1 + n2)), axis=-1)
+    member = (order < n1).astype(float)
+    member.setflags(write=False)
+    return member, False
+
+# One-sample t statistic of the sign-flipped samples (x: ... x n with NaN set to 0; signs: n x batch)
+def _paired_t(x, count, sumsq, signs):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = (x @ signs) / count[..., None]
+        var = (sumsq[..., None] - count[..., None] * mean**2) / (count[..., None] - 1)
+        return mean / np.sqrt(var / count[..., None])
+
+# Welch t statistic of the relabelled samples (z: pooled samples with NaN set to 0, valid: 0/1, member: N x batch)
+def _independent_t(z, valid, member):
+    n1, s1, q1 = valid @ member, z @ member, (z**2) @ member
+    n2 = valid.sum(axis=-1)[..., None] - n1
+    s2 = z.sum(axis=-1)[..., None] - s1
+    q2 = (z**2).sum(axis=-1)[..., None] - q1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        m1, m2 = s1 / n1, s2 / n2
+        v1 = (q1 - n1 * m1**2) / (n1 - 1)
+        v2 = (q2 - n2 * m2**2) / (n2 - 1)
+        return (m1 - m2) / np.sqrt(v1 / n1 + v2 / n2)
+
+# Mass of the clusters of cells above the threshold (t: fields x lat x lon), per cell and maximum per field
+def _cluster_mass(t, threshold):
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = scipy.ndimage.generate_binary_structure(2, 1) # clusters within each field only
+    abs_t = np.abs(np.nan_to_num(t))
+    mass_cells = np.zeros(t.shape)
+    max_mass = np.zeros(t.shape[0])
+    for above in (t > threshold, t < -threshold): # positive and negative clusters separately
+        labels, n_labels = scipy.ndimage.label(above, structure=structure)
+        if n_labels == 0:
+            continue
+        mass = np.bincount(labels.ravel(), weights=abs_t.ravel(), minlength=n_labels + 1)
+        mass[0] = 0
+        field = np.zeros(n_labels + 1, dtype=int)
+        field[labels.reshape(t.shape[0], -1)] = np.arange(t.shape[0])[:, None]
+        np.maximum.at(max_mass, field[1:], mass[1:])
+        mass_cells += mass[labels]
+    return mass_cells, max_mass
+
+def _permutation_batched(x, y=None, *, n_perm=10000, seed=0, field_test=None, n_field_dims=2,
+                         cluster_alpha=0.05, batch_size=100):
+    # Fields (leading dims) x cells (last n_field_dims dims, only for field tests) x samples
+    n_field_dims = n_field_dims if field_test else 0
+    shape = x.shape[:-1]
+    field_shape = shape[len(shape) - n_field_dims:]
+    n_cells = int(np.prod(field_shape))
+    x = np.asarray(x, dtype=float).reshape(-1, n_cells, x.shape[-1])
+
+    if y is None: # paired: sign flips of the differences
+        n = x.shape[-1]
+        valid = ~np.isnan(x)
+        x0 = np.where(valid, x, 0.)
+        count, sumsq = valid.sum(axis=-1), (x0**2).sum(axis=-1)
+        design, exact = _sign_flips(n, n_perm, seed)
+        statistic = lambda d: _paired_t(x0, count, sumsq, d.T)
+        t_obs = statistic(np.ones((1, n)))[..., 0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            effect = (x0.sum(axis=-1) / count) / np.sqrt((sumsq - x0.sum(axis=-1)**2 / count) / (count - 1))
+        df = n - 1
+    else: # independent: permutations of the pooled samples
+        n1, n2 = x.shape[-1], y.shape[-1]
+        z = np.concatenate([x, np.asarray(y, dtype=float).reshape(-1, n_cells, n2)], axis=-1)
+        valid = ~np.isnan(z)
+        with np.errstate(invalid="ignore"):
+            z = z - np.nanmean(z, axis=-1, keepdims=True) # the statistic is shift invariant; centring avoids cancellation
+        z0, valid = np.where(valid, z, 0.), valid.astype(float)
+        design, exact = _label_permutations(n1, n2, n_perm, seed)
+        statistic = lambda d: _independent_t(z0, valid, d.T)
+        identity = np.r_[np.ones(n1), np.zeros(n2)][None]
+        t_obs = statistic(identity)[..., 0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            m1 = (z0[..., :n1].sum(-1) / valid[..., :n1].sum(-1))
+            m2 = (z0[..., n1:].sum(-1) / valid[..., n1:].sum(-1))
+            n_all = valid.sum(-1)
+            pooled = np.sqrt(((z0**2).sum(-1) - valid[..., :n1].sum(-1) * m1**2 - valid[..., n1:].sum(-1) * m2**2) / (n_all - 2))
+            effect = (m1 - m2) / pooled
+        df = n1 + n2 - 2
+
+    # Exact enumeration includes the identity; random permutations add it to the count
+    extra = 0 if exact else 1
+    n_total = design.shape[0] + extra
+    abs_obs = np.abs(t_obs) * (1 - 1e-12) # identical permutations count as exceedances despite rounding
+    exceed = np.zeros(t_obs.shape)
+    maxima = []
+    if field_test == "cluster":
+        threshold = stats.t.ppf(1 - cluster_alpha / 2, df)
+        mass_obs, _ = _cluster_mass(t_obs.reshape((-1,) + field_shape), threshold)
+        mass_obs = mass_obs.reshape(t_obs.shape)
+
+    for start in range(0, design.shape[0], batch_size):
+        t_perm = statistic(design[start:start + batch_size]) # fields x cells x batch
+        with np.errstate(invalid="ignore"):
+            exceed += (np.abs(t_perm) >= abs_obs[..., None]).sum(axis=-1)
+        if field_test == "max":
+            maxima.append(np.nanmax(np.abs(np.nan_to_num(t_perm)), axis=1)) # fields x batch
+        elif field_test == "cluster":
+            t_perm = np.moveaxis(t_perm, -1, 1).reshape((-1,) + field_shape) # (fields x batch) x lat x lon
+            _, max_mass = _cluster_mass(t_perm, threshold)
+            maxima.append(max_mass.reshape(t_obs.shape[0], -1))
+
+    p = np.where(np.isnan(t_obs), np.nan, (exceed + extra) / n_total)
+    out = [t_obs, p, effect]
+    if field_test:
+        maxima = np.sort(np.concatenate(maxima, axis=-1), axis=-1) # fields x permutations
+        observed = abs_obs if field_test == "max" else mass_obs * (1 - 1e-12)
+        count = np.stack([maxima.shape[-1] - np.searchsorted(m, o.ravel(), side="left") for m, o in zip(maxima, observed)])
+        p_field = (count.reshape(t_obs.shape) + extra) / n_total
+        if field_test == "cluster":
+            p_field = np.where(mass_obs > 0, p_field, 1.) # cells outside clusters
+        out.append(np.where(np.isnan(t_obs), np.nan, p_field))
+    return tuple(o.reshape(shape) for o in out)
+
+@profile(labels=["field_test"])
+def xr_permutation_test(da1, da2=None, dim="time", n_perm=10000, seed=0, field_test=None, field_dims=("lat", "lon"),
+                        cluster_alpha=0.05, batch_size=100):
+    """
+    Permutation test across "dim": sign flips of da1 (paired samples, e.g. case differences) if da2 is None,
+    otherwise permutations of the pooled samples of da1 and da2 (independent samples).
+    Statistic: one-sample t (paired) or Welch t (independent); p-values are two-sided.
+    Effect size: mean/std of the differences (paired) or difference of the means/pooled std (independent).
+    n_perm : number of random permutations; sign flips are enumerated exactly if 2^n <= n_perm.
+    seed : seed of the permutations; the same permutations are used for all calls with the same sample sizes.
+    field_test : None | "max" | "cluster"; adds "p_field", the family-wise p-value over field_dims
+        ("max": maximum |t| over the field, "cluster": maximum mass of the clusters with two-sided p < cluster_alpha).
+        field_dims must not be chunked; "cluster" needs two field dims (4-connectivity).
+    batch_size : number of permutations evaluated at once for all cells (memory: cells x batch_size floats).
+    """
+
+    dim = [dim] if isinstance(dim, str) else dim
+    if field_test not in (None, "max", "cluster"):
+        raise ValueError(f"Unknown field_test '{field_test}'. Use None, 'max' or 'cluster'.")
+    field_dims = list(field_dims) if field_test else []
+    if field_test == "cluster" and len(field_dims) != 2:
+        raise ValueError("The cluster test needs two field dims, e.g. ('lat', 'lon').")
+
+    args = [da1] if da2 is None else [da1, da2]
+    names = ["statistic", "p", "effect_size"] + (["p_field"] if field_test else [])
+    out = xr.apply_ufunc(
+        _permutation_batched,
+        *args,
+        input_core_dims=[field_dims + dim] * len(args),
+        output_core_dims=[field_dims] * len(names),
+        exclude_dims=set(dim), # the samples may differ in size
+        kwargs=dict(n_perm=n_perm, seed=seed, field_test=field_test, n_field_dims=len(field_dims),
+                    cluster_alpha=cluster_alpha, batch_size=batch_size),
+        dask="parallelized",
+        output_dtypes=[float] * len(names),
+    )
+
+    return xr.Dataset(dict(zip(names, out)))
+
 # -------------------------------------------------------------------
 # Helpers
 # -------------------------------------------------------------------
 
+# Benjamini and Hochberg correction for many families at once (NumPy arrays)
+def fdr_bh(pvals, axis=None, alpha=0.05, out=None):
+    """
+    Benjamini–Hochberg FDR correction of each family of p-values, without looping over families.
+    - axis: axis or tuple of axes spanning one family (None: the whole array is one family);
+      every combination of the remaining axes is a separate family.
+    - NaNs (and infs) are ignored and preserved; each family is corrected for its number of finite p-values.
+    - out: array to write the adjusted p-values into (can be `pvals` itself for an in-place correction).
+    Returns (reject, p_adjusted) as in statsmodels' multipletests(method="fdr_bh").
+    """
+    pvals = np.asarray(pvals, dtype=float)
+    axes = tuple(range(pvals.ndim)) if axis is None else tuple(np.atleast_1d(axis) % max(pvals.ndim, 1))
+    other = tuple(i for i in range(pvals.ndim) if i not in axes)
+
+    # Families in rows (F x M)
+    p = np.transpose(pvals, other + axes)
+    shape = p.shape
+    p = p.reshape(int(np.prod(shape[:len(other)])), -1)
+
+    finite = np.isfinite(p)
+    m = finite.sum(axis=-1, keepdims=True) # family size
+    order = np.argsort(np.where(finite, p, np.inf), axis=-1) # NaNs last
+    p_sorted = np.take_along_axis(p, order, axis=-1)
+    with np.errstate(divide="ignore"):
+        ecdf = np.arange(1, p.shape[-1] + 1) / m # rank/m, as in statsmodels (inf for all-NaN families)
+
+    # Reject up to the largest rank with p <= rank/m * alpha
+    reject_sorted = p_sorted <= ecdf * alpha
+    reject_sorted = np.logical_or.accumulate(reject_sorted[:, ::-1], axis=-1)[:, ::-1]
+
+    # Adjusted p-values: cumulative minimum of p/(rank/m) from the largest rank
+    with np.errstate(divide="ignore", invalid="ignore"):
+        adj_sorted = np.where(np.take_along_axis(finite, order, axis=-1), p_sorted / ecdf, np.inf)
+    adj_sorted = np.minimum(np.minimum.accumulate(adj_sorted[:, ::-1], axis=-1)[:, ::-1], 1)
+
+    reject = np.empty(p.shape, dtype=bool)
+    adj = np.empty(p.shape)
+    np.put_along_axis(reject, order, reject_sorted, axis=-1)
+    np.put_along_axis(adj, order, adj_sorted, axis=-1)
+    adj = np.where(finite, adj, p)
+
+    # Back to the input layout
+    inverse = np.argsort(other + axes)
+    reject = np.transpose(reject.reshape(shape), inverse)
+    adj = np.transpose(adj.reshape(shape), inverse)
+    if out is not None:
+        out[...] = adj
+        adj = out
+    return reject, adj
+
 # Benjamini and Hochberg correction for multiple simultaneous tests (for ND arrays)
 def multitest_bh(pvals):
     """
     Benjamini–Hochberg FDR correction on an xarray.DataArray of p-values.
-    - Stacks all dims, corrects, and unstacks back.
+    - All dims form one family.
     - NaNs are ignored and preserved.
     - Returns a NEW DataArray with same shape/coords as input.
     """
-    da = pvals.astype(float)
-    stacked = da.stack(_all_dims=list(da.dims))
-    flat = stacked.data
-    if hasattr(flat, "compute"):  # dask array
-        flat = flat.compute()
-    flat = np.asarray(flat)
-    mask = np.isfinite(flat)
-    adj = flat.copy()
-    if mask.any():
-        adj[mask] = multipletests(flat[mask], method="fdr_bh")[1]
-    stacked_adj = xr.DataArray(adj, coords=stacked.coords, dims=stacked.dims)
-    unstacked = stacked_adj.unstack("_all_dims")
-    return unstacked.transpose(*pvals.dims)
+    return multitest_bh_families(pvals, family_dims=[])
+
+# Benjamini and Hochberg correction with one family per combination of family_dims (e.g., per variable and case)
+def multitest_bh_families(pvals, family_dims=("variable", "case")):
+    """
+    Benjamini–Hochberg FDR correction on an xarray.DataArray of p-values, correcting across all dims except `family_dims`.
+    Returns a NEW DataArray with same shape/coords as input.
+    """
+    values = pvals.astype(float).values # loads dask arrays
+    axes = tuple(i for i, d in enumerate(pvals.dims) if d not in family_dims)
+    if not axes: # every value is its own family
+        return pvals.astype(float).copy(data=fdr_bh(values[..., None], axis=-1)[1][..., 0])
+    return pvals.astype(float).copy(data=fdr_bh(values, axis=axes, out=values)[1])
 
 # Iterate groups for split_dim
 def _iter_groups(da, split_dim, *, test_dim="time"):
@@ -254,6 +641,7 @@ def _iter_groups(da, split_dim, *, test_dim="time"):
 # Xarray dataset integration (cases and variables are separate families)
 # -------------------------------------------------------------------
 
+@profile(labels=["method", "split_dim"])
 def xr_significance(
     ds,
     *,
@@ -261,14 +649,28 @@ def xr_significance(
     split_dim=None,                 # None | str; must be a coord on test_dim (e.g., "season")
     paired_samples=None,            # e.g., ["nfn-ssp1", "nfs-ssp1", "nac-ssp1"]
     independent_samples=None,       # e.g., [("recent","ssp1")]
-    multitest=False                 # FDR per variable & per case across remaining dims
+    multitest=False,                # FDR per variable & per case across remaining dims
+    method="batched",               # "batched" | "scipy"; passed to xr_wilcoxon and xr_mannwhitneyu; "permutation" for xr_permutation_test
+    n_perm=10000,                   # permutations per test (method="permutation")
+    field_test=None,                # None | "max" | "cluster"; field significance over field_dims (method="permutation")
+    field_dims=("lat", "lon"),      # dims of the field for field_test
+    seed=0,                         # seed of the permutations (the same permutations are reused for equal sample sizes)
+    chunks=None,                    # e.g., {"lat": 106, "lon": 106}; builds one lazy dask graph instead of computing eagerly
+    scheduler="processes",          # "processes" | "threads" | "synchronous" | "distributed" (local dask.distributed cluster)
+    n_workers=None,                 # number of worker processes/threads (default: all cores)
+    memory_limit=None               # memory limit per worker for the distributed scheduler, e.g., "4GB"
 ):
     """
     Run paired (Wilcoxon) and independent (MWU) tests in one call, with at most one split dimension.
     The split dimension must be a time-aligned coordinate (dims == (test_dim,)).
+    If `chunks` is given, all (variable, case, split) combinations are built as a single lazy graph over
+    spatial chunks and computed once in parallel; the FDR correction is applied afterwards.
+
+    With method="permutation", paired cases are tested with sign flips and independent pairs with permutations
+    of the pooled samples (t statistics, see xr_permutation_test); field_test adds the field-wise "p_field".
 
     Output dims typically: ['variable', 'case', *other non-time dims*, split_dim?]
-    Variables: ['statistic', 'p', 'effect_size']
+    Variables: ['statistic', 'p', 'effect_size'] (+ 'p_field')
     """
 
     if (not paired_samples) and (not independent_samples):
@@ -276,6 +678,23 @@ def xr_significance(
     if "case" not in ds.dims:
         raise ValueError("Dataset must have a 'case' dimension to select cases.")
 
+    # Spatial chunks only; the test dimension must stay in one chunk and coordinates stay in memory for grouping
+    lazy = chunks is not None
+    if lazy:
+        if method == "permutation" and field_test:
+            chunks = {d: c for d, c in chunks.items() if d not in field_dims} # the field test needs whole fields
+        ds = ds.chunk({**chunks, test_dim: -1})
+        ds = ds.assign_coords({name: coord.compute() for name, coord in ds.coords.items()})
+
+    # Wilcoxon (paired) and MWU (independent), or permutation tests
+    def _test(da1, da2=None):
+        if method == "permutation":
+            return xr_permutation_test(da1, da2, dim=test_dim, n_perm=n_perm, seed=seed,
+                                       field_test=field_test, field_dims=field_dims)
+        if da2 is None:
+            return xr_wilcoxon(da1, dim=test_dim, method=method)
+        return xr_mannwhitneyu(da1, da2, dim=test_dim, method=method)
+
     results = []
 
     for var in ds.data_vars:
@@ -290,7 +709,8 @@ def xr_significance(
 
                 sub = []
                 for labels, da_g in _iter_groups(da_case, split_dim, test_dim=test_dim):
-                    res = xr_wilcoxon(da_g, dim=test_dim)
+                    with section("xr_significance.test", variable=var, case=case_label, **labels):
+                        res = _test(da_g)
 
                     # Attach split coord back as a size-1 dimension for clean concat
                     for name, val in labels.items():
@@ -313,7 +733,8 @@ def xr_significance(
                     # Align da2 to the time subset used by da1_g after grouping
                     da2_g = da2.sel({test_dim: da1_g[test_dim]})
 
-                    res = xr_mannwhitneyu(da1_g, da2_g, dim=test_dim)
+                    with section("xr_significance.test", variable=var, case=f"{c1}-{c2}", **labels):
+                        res = _test(da1_g, da2_g)
 
                     for name, val in labels.items():
                         res = res.expand_dims({name: [val]})
@@ -328,9 +749,9 @@ def xr_significance(
         # Concatenate all cases for this variable
         var_out = xr.concat(blocks, dim="case", coords="all")
 
-        # FDR per variable & per case
-        if multitest:
-            var_out["p"] = var_out["p"].groupby("case").map(multitest_bh)
+        # FDR per variable & per case (needs all p-values of a family, so deferred in lazy mode)
+        if multitest and not lazy:
+            var_out["p"] = multitest_bh_families(var_out["p"], family_dims=["case"])
 
         # Attach variable for outer concat across variables
         results.append(var_out.expand_dims(variable=[var]))
@@ -338,7 +759,25 @@ def xr_significance(
     if not results:
         raise ValueError("No tests were produced. Check cases/pairs and split settings.")
 
-    return xr.concat(results, dim="variable", coords="all")
+    out = xr.concat(results, dim="variable", coords="all")
+
+    if lazy:
+        out = _compute_parallel(out, scheduler=scheduler, n_workers=n_workers, memory_limit=memory_limit)
+        if multitest:
+            out["p"] = multitest_bh_families(out["p"], family_dims=["variable", "case"])
+
+    return out
+
+# Compute a lazy result on a local dask scheduler
+@profile(labels=["scheduler"])
+def _compute_parallel(obj, *, scheduler="processes", n_workers=None, memory_limit=None):
+    if scheduler == "distributed":
+        from dask.distributed import Client, LocalCluster
+        with LocalCluster(n_workers=n_workers, threads_per_worker=1, memory_limit=memory_limit or "auto") as cluster, Client(cluster):
+            return obj.compute()
+    if memory_limit is not None:
+        raise ValueError("`memory_limit` is only supported with scheduler='distributed'.")
+    return obj.compute(scheduler=scheduler, num_workers=n_workers)
 
 
 # Encode significance levels with stars( for arrays)
@@ -361,7 +800,7 @@ def encode_significance(p_da: xr.DataArray, *, nan_label: str = "") -> xr.DataAr
     stars_map = np.array(["***", "**", "*", ""], dtype=object)
 
     def _encode_array(x):
-        # x is a NumPy array (not dask) here due to apply_ufunc wrapping
+        # x is a whole NumPy array (or dask block) here, the encoding is vectorized
         x = np.asarray(x, dtype=float)
         out = np.full(x.shape, nan_label, dtype=object)
         m = np.isfinite(x)
@@ -373,7 +812,6 @@ def encode_significance(p_da: xr.DataArray, *, nan_label: str = "") -> xr.DataAr
     return xr.apply_ufunc(
         _encode_array,
         p_da,
-        vectorize=True,
         dask="parallelized",
         output_dtypes=[object],
     )
@@ -385,15 +823,42 @@ def _format_pvalue_scalar(p, *, nan_label=""):
         return nan_label
     return "P < 0.001" if p < 0.001 else f"P = {p:.3f}"
 
+# Labels "P = 0.001" ... "P = 1.000" for the lookup in _format_pvalue_array
+_pvalue_labels = np.array([f"P = {k/1000:.3f}" for k in range(1001)], dtype=object)
+
+def _format_pvalue_array(p, *, nan_label=""):
+    """
+    Same labels as _format_pvalue_scalar for a whole array, without formatting each value:
+    p is rounded to 3 decimals and the label is taken from a lookup table.
+    Values close to a rounding tie (or outside [0, 1]) are formatted individually, so the strings are identical.
+    """
+    p = np.asarray(p, dtype=float)
+    out = np.full(p.shape, nan_label, dtype=object)
+    out[p < 0.001] = "P < 0.001"
+    ok = (p >= 0.001) & (p <= 1)
+    scaled = p[ok]*1000
+    k = np.rint(scaled).astype(int)
+    labels = _pvalue_labels[k]
+    tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    labels[tie] = [f"P = {x:.3f}" for x in p[ok][tie].tolist()]
+    out[ok] = labels
+    other = p > 1
+    out[other] = [f"P = {x:.3f}" for x in p[other].tolist()]
+    return out
+
 def format_pvalue_da(p_da: xr.DataArray, *, nan_label: str = "") -> xr.DataArray:
     return xr.apply_ufunc(
-        lambda x: np.vectorize(_format_pvalue_scalar)(x, nan_label=nan_label),
+        lambda x: _format_pvalue_array(x, nan_label=nan_label),
         p_da,
-        vectorize=True,
         dask="parallelized",
         output_dtypes=[object],
     )
 
+# Format a float array with a format spec (e.g., ".4g"), one string per element
+def _format_float_array(x, fmt):
+    x = np.asarray(x, dtype=float)
+    return np.array([format(v, fmt) for v in x.ravel().tolist()], dtype=object).reshape(x.shape)
+
 
 # Summarize statistics: pulls statistic, p, and effect_size from the stat dimension
 # Uses encode_significanc(p) to get the stars and the p-labeling rule
@@ -428,19 +893,21 @@ def format_stat_strings(
     # p label with "< 0.001" rule
     p_str = format_pvalue_da(p, nan_label=nan_label)
 
-    def _format_scalar(a, ptxt, c, s):
+    def _format_array(a, ptxt, c, s):
+        # Whole arrays: numbers are formatted once per non-blank element, the rest is concatenated elementwise
+        a, c = np.asarray(a, dtype=float), np.asarray(c, dtype=float)
+        a, ptxt, c, s = np.broadcast_arrays(a, ptxt, c, s)
         # Blank if any numeric component missing or p label missing
-        if np.isnan(a) or (ptxt == nan_label) or np.isnan(c):
-            return nan_label
-        prefix = (s + " ") if s else ""
-        return f"{prefix}(statistic = {a:{stat_fmt}}, {ptxt}, effect size = {c:{eff_fmt}})"
+        keep = ~(np.isnan(a) | (ptxt == nan_label) | np.isnan(c))
+        strings = np.full(a.shape, nan_label, dtype=object)
+        prefix = np.where(s[keep] != "", s[keep] + " ", "").astype(object)
+        strings[keep] = (prefix + "(statistic = " + _format_float_array(a[keep], stat_fmt) + ", " + ptxt[keep]
+                         + ", effect size = " + _format_float_array(c[keep], eff_fmt) + ")")
+        return strings
 
     strings = xr.apply_ufunc(
-        _format_scalar,
+        _format_array,
         stat, p_str, eff, stars,
-        input_core_dims=[[], [], [], []],
-        output_core_dims=[[]],
-        vectorize=True,
         dask="parallelized",
         output_dtypes=[object],
     )
@@ -497,4 +964,39 @@ def summarize_stat_dim(
     return xr.Dataset(
         out_vars,
         coords={k: v for k, v in ds.coords.items() if k in out_vars[sample_var].coords},
-    )
\ No newline at end of file
+    )
+
+# Table of statistics strings (e.g., output of summarize_stat_dim): one row per variable and remaining dims, one column per case
+# Written to CSV, or to Excel with one sheet per value of `sheet_dim` (e.g., "season") if path ends with .xlsx
+def stat_table(
+    strings: xr.Dataset,
+    path: str | None = None,
+    *,
+    column_dim: str = "case",
+    sheet_dim: str | None = None,
+    row_dim: str = "variable",
+):
+    """
+    Returns the table as a pandas DataFrame (or a dict of DataFrames per `sheet_dim` value) and optionally writes it.
+    """
+    da = strings.to_array(row_dim)
+
+    def _table(d):
+        return d.to_dataset(column_dim).to_dataframe()
+
+    if sheet_dim is None:
+        tables = _table(da)
+    else:
+        tables = {str(label): _table(da.sel({sheet_dim: label}, drop=True)) for label in da[sheet_dim].values}
+
+    if path is not None:
+        if path.endswith(".xlsx"):
+            import pandas as pd
+            with pd.ExcelWriter(path, mode="w") as writer:
+                for name, table in (tables.items() if sheet_dim is not None else [("Sheet1", tables)]):
+                    table.to_excel(writer, sheet_name=name)
+        elif sheet_dim is None:
+            tables.to_csv(path)
+        else:
+            raise ValueError("`sheet_dim` needs an Excel file (.xlsx); for CSV, keep the dimension in the rows.")
+    return tables
@@ -4,6 +4,8 @@
 basedir = '/net/exo/landclim/pesieber/data/FB_biodiv/data_ETH-research-collection/'
 dpath_proc = basedir + '15years/'
 dpath_luc = basedir + 'luc_evaluation/'
+dpath_zarr = basedir + '15years_zarr/' # chunked Zarr copy of dpath_proc (python func_load.py), used instead of NetCDF if it exists
+dpath_cache = basedir + 'cache/' # cached intermediate results (func_cache.py)
 
 
 